@@ -1,14 +1,33 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, BackgroundTasks, Query, Response
+from fastapi.responses import StreamingResponse, ORJSONResponse
 from fastapi.middleware.cors import CORSMiddleware
-from pymongo import MongoClient
-from pydantic import BaseModel
+from starlette.routing import Match
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import UpdateOne, ReturnDocument, monitoring
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from pydantic import BaseModel, ConfigDict
 from datetime import datetime, timedelta
 import uuid
-import requests
+import zlib
+import gzip
+import mmap
+import functools
+import math
+import json
+import orjson
+import base64
+import time
+import httpx
+import random
 import os
 from typing import Optional, List
+from collections import deque, OrderedDict
 import asyncio
+import heapq
 from contextlib import asynccontextmanager
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
 
 # Pydantic models
 class UserCreate(BaseModel):
@@ -50,72 +69,1528 @@ class Transaction(BaseModel):
     created_at: datetime
     payment_id: Optional[str] = None
 
-# Background task for calculating daily rewards
-async def calculate_daily_rewards():
-    """Calculate and distribute daily rewards for all active stakes"""
+# Response models; stored documents also carry bookkeeping fields, which are passed through
+class UserResponse(User):
+    model_config = ConfigDict(extra="allow")
+    accrued_rewards: float = 0.0
+
+class StakeResponse(StakeRecord):
+    model_config = ConfigDict(extra="allow")
+    shard: Optional[int] = None
+    last_reward_date: Optional[datetime] = None
+    end_date: Optional[datetime] = None
+
+class TransactionResponse(Transaction):
+    model_config = ConfigDict(extra="allow")
+    stake_id: Optional[str] = None
+    completed_at: Optional[datetime] = None
+
+# Reward engine bookkeeping kept on the documents, left out of API responses
+STAKE_RESPONSE_PROJECTION = {"_id": 0, "paid_passes": 0}
+USER_RESPONSE_PROJECTION = {"_id": 0, "reward_credits": 0, "deposit_credits": 0}
+
+# Platform totals snapshot, maintained incrementally by the write paths
+PLATFORM_TOTALS_ID = "platform_totals"
+PLATFORM_TOTALS_RECONCILE_ID = "platform_totals_reconcile"
+PLATFORM_TOTALS_RECONCILE_INTERVAL = int(os.environ.get('PLATFORM_TOTALS_RECONCILE_INTERVAL', '3600'))
+PLATFORM_TOTALS_FIELDS = (
+    "total_users", "total_staked", "total_rewards", "total_balance",
+    "accrual_rate", "accrual_weighted_since"
+)
+
+# Accrual bookkeeping: with rate = amount * daily_rate summed over active stakes and
+# weighted_since = sum of rate * (days since ACCRUAL_EPOCH at last payout), the platform-wide
+# unsettled reward is rate * days(now) - weighted_since, readable without scanning stakes
+ACCRUAL_EPOCH = datetime(2024, 1, 1)
+
+def _accrual_days(moment):
+    return (moment - ACCRUAL_EPOCH).total_seconds() / 86400
+
+def _platform_accrued(totals, now):
+    return max(totals["accrual_rate"] * _accrual_days(now) - totals["accrual_weighted_since"], 0)
+
+async def _scan_platform_totals():
+    """Compute all platform totals with a single pass over users and one over active stakes"""
+    result = await db.users.aggregate([
+        {"$group": {
+            "_id": None,
+            "total_users": {"$sum": 1},
+            "total_staked": {"$sum": "$staked_amount"},
+            "total_rewards": {"$sum": "$total_rewards"},
+            "total_balance": {"$sum": "$balance"}
+        }}
+    ]).to_list(length=None)
+    totals = result[0] if result else {}
+    
+    rate = {"$multiply": ["$amount", {"$ifNull": ["$daily_rate", 0.30]}]}
+    last_reward_days = {"$divide": [
+        {"$subtract": [{"$ifNull": ["$last_reward_date", "$start_date"]}, ACCRUAL_EPOCH]},
+        86400000
+    ]}
+    accrual = await db.stakes.aggregate([
+        {"$match": {"is_active": True}},
+        {"$group": {
+            "_id": None,
+            "accrual_rate": {"$sum": rate},
+            "accrual_weighted_since": {"$sum": {"$multiply": [rate, last_reward_days]}}
+        }}
+    ]).to_list(length=None)
+    if accrual:
+        totals.update(accrual[0])
+    return {field: totals.get(field, 0) for field in PLATFORM_TOTALS_FIELDS}
+
+async def _inc_platform_totals(**deltas):
+    """Apply incremental changes to the platform totals snapshot"""
+    await db.platform_stats.update_one(
+        {"_id": PLATFORM_TOTALS_ID},
+        {"$inc": deltas, "$set": {"updated_at": datetime.utcnow()}},
+        upsert=True
+    )
+
+async def reconcile_platform_totals():
+    """Compare the snapshot with a full scan and return the drift and the part corrected"""
+    scanned = await _scan_platform_totals()
+    snapshot = await db.platform_stats.find_one({"_id": PLATFORM_TOTALS_ID}) or {}
+    drift = {field: scanned[field] - snapshot.get(field, 0) for field in PLATFORM_TOTALS_FIELDS}
+    
+    # Increments landing between the scan and the snapshot read look like drift that the
+    # next run no longer sees, so only drift unchanged since the last run is corrected, and
+    # with $inc so that increments applied meanwhile are kept
+    previous = snapshot.get("last_drift") or {}
+    corrected = {
+        field: value for field, value in drift.items()
+        if abs(value) > 1e-6 and abs(value - previous.get(field, 0)) <= 1e-6
+    }
+    now = datetime.utcnow()
+    update = {"$set": {
+        "reconciled_at": now,
+        "last_drift": {field: value - corrected.get(field, 0) for field, value in drift.items()}
+    }}
+    if corrected:
+        update["$inc"] = corrected
+        update["$set"]["updated_at"] = now
+    await db.platform_stats.update_one({"_id": PLATFORM_TOTALS_ID}, update, upsert=True)
+    return drift, corrected
+
+async def get_platform_totals():
+    """Read the platform totals snapshot, building it on first use"""
+    snapshot = await db.platform_stats.find_one({"_id": PLATFORM_TOTALS_ID})
+    if not snapshot:
+        snapshot = await _scan_platform_totals()
+        now = datetime.utcnow()
+        await db.platform_stats.update_one(
+            {"_id": PLATFORM_TOTALS_ID},
+            {"$set": {**snapshot, "updated_at": now, "reconciled_at": now}},
+            upsert=True
+        )
+    return {field: snapshot.get(field, 0) for field in PLATFORM_TOTALS_FIELDS}
+
+async def _claim_platform_totals_reconcile():
+    """Take the next reconcile slot, so one worker across all replicas scans per interval"""
+    now = datetime.utcnow()
+    try:
+        await db.platform_stats.update_one(
+            {"_id": PLATFORM_TOTALS_RECONCILE_ID, "next_run_at": {"$lte": now}},
+            {"$set": {
+                "next_run_at": now + timedelta(seconds=PLATFORM_TOTALS_RECONCILE_INTERVAL),
+                "worker": REWARD_WORKER_ID
+            }},
+            upsert=True
+        )
+    except DuplicateKeyError:
+        # The slot exists and is not due yet
+        return False
+    return True
+
+async def reconcile_platform_totals_periodically():
+    """Report drift in the platform totals snapshot and correct it once it persists"""
     while True:
+        # Sleep first and poll the shared slot, so restarting every worker does not start a scan in each
+        await asyncio.sleep(PLATFORM_TOTALS_RECONCILE_INTERVAL / 4)
         try:
-            # Get all active stakes
-            stakes = list(db.stakes.find({"is_active": True}))
-            
-            for stake in stakes:
-                # Calculate time since last reward
-                last_reward = stake.get('last_reward_date', stake['start_date'])
-                now = datetime.utcnow()
-                
-                # Check if 24 hours have passed
-                if now - last_reward >= timedelta(hours=24):
-                    # Calculate reward (30% daily)
-                    daily_reward = stake['amount'] * 0.30
-                    
-                    # Update user balance
-                    db.users.update_one(
-                        {"id": stake['user_id']},
-                        {
-                            "$inc": {
-                                "balance": daily_reward,
-                                "total_rewards": daily_reward
-                            }
-                        }
-                    )
-                    
-                    # Update stake record
-                    db.stakes.update_one(
-                        {"id": stake['id']},
-                        {
-                            "$inc": {"total_earned": daily_reward},
-                            "$set": {"last_reward_date": now}
+            if not await _claim_platform_totals_reconcile():
+                continue
+            drift, corrected = await reconcile_platform_totals()
+            if any(abs(value) > 1e-6 for value in drift.values()):
+                print(f"Platform totals drift: {drift}, corrected: {corrected}")
+        except Exception as e:
+            print(f"Error reconciling platform totals: {e}")
+
+# Daily rollups: one document per UTC day for the platform and one per user per day, kept
+# current with $inc upserts from the write paths so time series are a range read on _id
+ROLLUP_FIELDS = (
+    "new_users", "new_stakes", "staked_amount", "unstakes", "unstaked_amount",
+    "reward_count", "rewards_distributed", "deposits", "deposit_amount", "transaction_count"
+)
+
+def _rollup_day(moment):
+    return moment.strftime("%Y-%m-%d")
+
+def _rollup_id(day, user_id=None):
+    return f"user:{user_id}:{day}" if user_id else f"platform:{day}"
+
+async def _inc_daily_rollups_bulk(increments):
+    """Apply {(day, user_id or None): deltas} to the rollups in one bulk write"""
+    if not increments:
+        return
+    await db.daily_rollups.bulk_write([
+        UpdateOne(
+            {"_id": _rollup_id(day, user_id)},
+            {"$inc": deltas, "$setOnInsert": {"date": day, "user_id": user_id}},
+            upsert=True
+        )
+        for (day, user_id), deltas in increments.items()
+    ], ordered=False)
+
+def _add_rollup_deltas(increments, day, user_id, **deltas):
+    """Accumulate deltas for a user's day and the matching platform day"""
+    for key in ((day, None), (day, user_id)) if user_id else ((day, None),):
+        bucket = increments.setdefault(key, {})
+        for field, value in deltas.items():
+            bucket[field] = bucket.get(field, 0) + value
+
+async def _inc_daily_rollups(moment, user_id=None, **deltas):
+    """Apply incremental changes to the platform rollup for the day and to the user's, if given"""
+    increments = {}
+    _add_rollup_deltas(increments, _rollup_day(moment), user_id, **deltas)
+    await _inc_daily_rollups_bulk(increments)
+
+async def get_daily_rollups(start, end, user_id=None):
+    """Range read of the rollups between two dates inclusive, keyed by YYYY-MM-DD"""
+    query = {"_id": {
+        "$gte": _rollup_id(_rollup_day(start), user_id),
+        "$lte": _rollup_id(_rollup_day(end), user_id)
+    }}
+    return {doc["date"]: doc async for doc in db.daily_rollups.find(query)}
+
+def _day_of(date_expression):
+    return {"$dateToString": {"format": "%Y-%m-%d", "date": date_expression}}
+
+async def _merge_into_rollups(collection, match, day, user_field, accumulators):
+    """Group documents per day (and per user) server-side and add the sums into the rollups"""
+    group_id = {"date": day}
+    if user_field:
+        group_id["user_id"] = user_field
+    rollup_id = (
+        {"$concat": ["user:", "$_id.user_id", ":", "$_id.date"]} if user_field
+        else {"$concat": ["platform:", "$_id.date"]}
+    )
+    fields = list(accumulators)
+    pipeline = [
+        {"$match": match},
+        {"$group": {"_id": group_id, **accumulators}},
+        {"$project": {
+            "_id": rollup_id,
+            "date": "$_id.date",
+            "user_id": "$_id.user_id" if user_field else None,
+            **{field: 1 for field in fields}
+        }},
+        {"$merge": {
+            "into": "daily_rollups",
+            "on": "_id",
+            "whenMatched": [{"$set": {
+                field: {"$add": [{"$ifNull": [f"${field}", 0]}, f"$$new.{field}"]}
+                for field in fields
+            }}],
+            "whenNotMatched": "insert"
+        }}
+    ]
+    await collection.aggregate(pipeline).to_list(length=None)
+
+async def backfill_daily_rollups():
+    """Rebuild every rollup from users, transactions, reward buckets and the archive"""
+    def of_type(tx_type, value):
+        return {"$sum": {"$cond": [{"$eq": ["$type", tx_type]}, value, 0]}}
+    
+    await db.daily_rollups.delete_many({})
+    await _merge_into_rollups(db.transactions, {}, _day_of("$created_at"), "$user_id", {
+        "transaction_count": {"$sum": 1},
+        "new_stakes": of_type("stake", 1),
+        "staked_amount": of_type("stake", "$amount"),
+        "unstakes": of_type("unstake", 1),
+        "unstaked_amount": of_type("unstake", "$amount"),
+        "reward_count": of_type("reward", 1),
+        "rewards_distributed": of_type("reward", "$amount")
+    })
+    # Deposits count on the day they were credited, like the live write path
+    await _merge_into_rollups(
+        db.transactions,
+        {"type": "deposit", "status": "completed"},
+        _day_of({"$ifNull": ["$completed_at", "$created_at"]}),
+        "$user_id",
+        {"deposits": {"$sum": 1}, "deposit_amount": {"$sum": "$amount"}}
+    )
+    archived = await asyncio.to_thread(_archived_rollup_increments)
+    await _inc_daily_rollups_bulk(archived)
+    await _merge_into_rollups(db.reward_buckets, {}, "$date", "$user_id", {
+        "transaction_count": {"$sum": "$count"},
+        "reward_count": {"$sum": "$count"},
+        "rewards_distributed": {"$sum": "$amount"}
+    })
+    # Platform days are the sum of the user days, plus signups from the users collection
+    await _merge_into_rollups(
+        db.daily_rollups,
+        {"user_id": {"$ne": None}},
+        "$date",
+        None,
+        {field: {"$sum": f"${field}"} for field in ROLLUP_FIELDS if field != "new_users"}
+    )
+    await _merge_into_rollups(db.users, {}, _day_of("$created_at"), None, {"new_users": {"$sum": 1}})
+    return await db.daily_rollups.count_documents({})
+
+# Per-user stats subdocument on the user, kept current by the write paths so the portfolio and
+# milestone sections of the analytics are a point read; rebuild-user-stats recomputes it
+USER_STATS_COUNTERS = (
+    "active_stakes", "completed_stakes", "total_stakes", "total_invested",
+    "total_transactions", "reward_transactions"
+)
+# Write paths $inc single stats fields, which also creates a partial subdocument on users
+# that predate it; only stats carrying this version were computed in full
+USER_STATS_VERSION = 1
+USER_STATS_BATCH_SIZE = int(os.environ.get('USER_STATS_BATCH_SIZE', '1000'))
+USER_STATS_CONCURRENCY = int(os.environ.get('USER_STATS_CONCURRENCY', '4'))
+
+def _empty_user_stats():
+    return {"version": USER_STATS_VERSION, **{field: 0 for field in USER_STATS_COUNTERS}}
+
+async def compute_user_stats(user_ids):
+    """Recompute the stats subdocument for a batch of users from stakes and every ledger"""
+    stats = {user_id: _empty_user_stats() for user_id in user_ids}
+    match = {"$match": {"user_id": {"$in": user_ids}}}
+    
+    async for row in db.stakes.aggregate([match, {"$group": {
+        "_id": "$user_id",
+        "total_stakes": {"$sum": 1},
+        "active_stakes": {"$sum": {"$cond": ["$is_active", 1, 0]}},
+        "total_invested": {"$sum": "$amount"},
+        "biggest_stake": {"$max": "$amount"},
+        "first_stake_date": {"$min": "$start_date"}
+    }}]):
+        user_stats = stats[row.pop("_id")]
+        user_stats.update(row)
+        user_stats["completed_stakes"] = row["total_stakes"] - row["active_stakes"]
+    
+    async for row in db.transactions.aggregate([match, {"$group": {
+        "_id": "$user_id",
+        "total": {"$sum": 1},
+        "rewards": {"$sum": {"$cond": [{"$eq": ["$type", "reward"]}, 1, 0]}}
+    }}]):
+        stats[row["_id"]]["total_transactions"] += row["total"]
+        stats[row["_id"]]["reward_transactions"] += row["rewards"]
+    
+    async for row in db.reward_buckets.aggregate([match, {"$group": {
+        "_id": "$user_id",
+        "count": {"$sum": "$count"}
+    }}]):
+        stats[row["_id"]]["total_transactions"] += row["count"]
+        stats[row["_id"]]["reward_transactions"] += row["count"]
+    
+    async for summary in db.archive_summaries.find({"_id": {"$in": user_ids}}, {"count": 1, "reward_count": 1}):
+        stats[summary["_id"]]["total_transactions"] += summary["count"]
+        stats[summary["_id"]]["reward_transactions"] += summary["reward_count"]
+    return stats
+
+async def rebuild_user_stats(batch_size=USER_STATS_BATCH_SIZE, concurrency=USER_STATS_CONCURRENCY):
+    """Recompute every user's stats in batches, several batches at a time"""
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async def rebuild_batch(user_ids):
+        async with semaphore:
+            stats = await compute_user_stats(user_ids)
+            await db.users.bulk_write([
+                UpdateOne({"id": user_id}, {"$set": {"stats": user_stats}})
+                for user_id, user_stats in stats.items()
+            ], ordered=False)
+            return len(user_ids)
+    
+    tasks = []
+    batch = []
+    async for user in db.users.find({}, {"_id": 0, "id": 1}):
+        batch.append(user["id"])
+        if len(batch) >= batch_size:
+            tasks.append(asyncio.create_task(rebuild_batch(batch)))
+            batch = []
+    if batch:
+        tasks.append(asyncio.create_task(rebuild_batch(batch)))
+    return sum(await asyncio.gather(*tasks))
+
+# Finished reward passes are kept this long for the admin history, then expire by TTL
+REWARD_PASS_HISTORY_DAYS = int(os.environ.get('REWARD_PASS_HISTORY_DAYS', '7'))
+
+# Indexes required by the query shapes used in this module
+REQUIRED_INDEXES = [
+    ("users", [("id", 1)], {"unique": True}),
+    ("users", [("email", 1)], {"unique": True}),
+    ("users", [("created_at", 1)], {}),
+    ("stakes", [("id", 1)], {"unique": True}),
+    ("stakes", [("user_id", 1), ("start_date", -1), ("id", -1)], {}),
+    ("stakes", [("is_active", 1), ("last_reward_date", 1)], {}),
+    ("stakes", [("shard", 1), ("is_active", 1), ("last_reward_date", 1)], {}),
+    ("stakes", [("start_date", 1)], {}),
+    ("transactions", [("id", 1)], {"unique": True}),
+    ("transactions", [("user_id", 1), ("created_at", -1), ("id", -1)], {}),
+    ("transactions", [("user_id", 1), ("type", 1), ("created_at", 1)], {}),
+    ("transactions", [("payment_id", 1)], {"sparse": True}),
+    ("transactions", [("type", 1), ("created_at", 1)], {}),
+    ("transactions", [("created_at", 1)], {}),
+    ("transactions", [("pending", 1)], {"sparse": True}),
+    ("payment_callbacks", [("status", 1), ("received_at", 1)], {}),
+    ("reward_passes", [("status", 1), ("heartbeat_at", 1)], {}),
+    ("reward_passes", [("started_at", -1)], {}),
+    ("reward_passes", [("finished_at", 1)], {"expireAfterSeconds": REWARD_PASS_HISTORY_DAYS * 86400}),
+    ("reward_buckets", [("user_id", 1), ("day_start", -1)], {}),
+    ("reward_buckets", [("day_start", 1)], {}),
+    ("reward_buckets", [("payouts.pending", 1)], {"sparse": True}),
+]
+
+async def ensure_indexes():
+    """Create any missing required index in the background and return the ones created"""
+    created = []
+    for collection_name, keys, options in REQUIRED_INDEXES:
+        collection = db[collection_name]
+        existing = await collection.index_information()
+        if any(index["key"] == keys for index in existing.values()):
+            continue
+        try:
+            name = await collection.create_index(keys, background=True, **options)
+            created.append(f"{collection_name}.{name}")
+        except Exception as e:
+            print(f"Error creating index {keys} on {collection_name}: {e}")
+    if created:
+        print(f"Created indexes: {', '.join(created)}")
+    return created
+
+# Representative filters for every query shape issued by the endpoints and background jobs
+QUERY_SHAPES = [
+    ("user by id", "users", {"id": "user-id"}, None),
+    ("user by email", "users", {"email": "user@example.com"}, None),
+    ("users created in range", "users", {"created_at": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("stakes by user", "stakes", {"user_id": "user-id"}, {"start_date": -1, "id": -1}),
+    ("active stake by id", "stakes", {"id": "stake-id", "is_active": True}, None),
+    ("active stakes", "stakes", {"is_active": True}, None),
+    ("due stakes", "stakes", {
+        "shard": {"$in": [0, 1]},
+        "is_active": True,
+        "$or": [
+            {"last_reward_date": {"$lte": datetime(2024, 1, 1)}},
+            {"last_reward_date": {"$exists": False}, "start_date": {"$lte": datetime(2024, 1, 1)}}
+        ]
+    }, None),
+    ("stakes started in range", "stakes", {"start_date": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("user transactions", "transactions", {"user_id": "user-id"}, {"created_at": -1, "id": -1}),
+    ("user transactions by type", "transactions", {"user_id": "user-id", "type": "reward"}, None),
+    ("user rollups in range", "daily_rollups", {
+        "_id": {"$gte": "user:user-id:2024-01-01", "$lte": "user:user-id:2024-01-31"}
+    }, None),
+    ("transaction by payment", "transactions", {"payment_id": "payment-id"}, None),
+    ("queued payment callbacks", "payment_callbacks", {"status": {"$in": ["queued", "processing"]}}, {"received_at": 1}),
+    ("platform rollups in range", "daily_rollups", {
+        "_id": {"$gte": "platform:2024-01-01", "$lte": "platform:2024-01-31"}
+    }, None),
+    ("transactions in range", "transactions", {"created_at": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("user reward buckets", "reward_buckets", {"user_id": "user-id"}, {"day_start": -1}),
+    ("reward buckets in range", "reward_buckets", {"day_start": {"$gte": datetime(2024, 1, 1)}}, None),
+    ("pending bucketed rewards", "reward_buckets", {"payouts.pending": {"$exists": True}}, None),
+]
+
+def _plan_stages(plan):
+    """Flatten the stage names of a winning plan tree"""
+    stages = [plan.get("stage")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
+
+async def explain_query_shapes():
+    """Explain every known query shape and flag the ones that fall back to a COLLSCAN"""
+    report = []
+    for name, collection_name, query, sort in QUERY_SHAPES:
+        command = {"find": collection_name, "filter": query}
+        if sort:
+            command["sort"] = sort
+        explanation = await db.command({"explain": command, "verbosity": "queryPlanner"})
+        stages = _plan_stages(explanation["queryPlanner"]["winningPlan"])
+        report.append({
+            "query": name,
+            "collection": collection_name,
+            "stages": stages,
+            "collscan": "COLLSCAN" in stages
+        })
+    return report
+
+# Reward engine configuration
+REWARD_BATCH_SIZE = int(os.environ.get('REWARD_BATCH_SIZE', '1000'))
+REWARD_INTERVAL = timedelta(hours=24)
+# "settle" pays every stake each 24h; "accrual" computes rewards on read and only
+# writes them on stake/unstake or when a stake has gone ACCRUAL_COMPACTION_DAYS unsettled
+REWARD_MODE = os.environ.get('REWARD_MODE', 'settle')
+ACCRUAL_COMPACTION_AGE = timedelta(days=int(os.environ.get('ACCRUAL_COMPACTION_DAYS', '7')))
+# "transactions" records every payout as its own transaction document; "buckets" appends it
+# to one reward_buckets document per user per day, which listings and analytics expand
+REWARD_LEDGER = os.environ.get('REWARD_LEDGER', 'transactions')
+REWARD_STAKE_PROJECTION = {
+    "_id": 0, "id": 1, "user_id": 1, "amount": 1, "daily_rate": 1,
+    "start_date": 1, "last_reward_date": 1, "shard": 1
+}
+
+def _last_reward_date(stake):
+    return stake.get('last_reward_date', stake['start_date'])
+
+def _accrued_reward(stake, now):
+    """Reward earned by a stake since its last payout, pro-rated to the second"""
+    elapsed = max((now - _last_reward_date(stake)).total_seconds(), 0)
+    return stake['amount'] * stake.get('daily_rate', 0.30) * elapsed / 86400
+
+# Stakes are partitioned into REWARD_SHARDS shards by a hash of their id; each shard is
+# paid by whichever worker holds its lease, so several processes never pay the same stake
+REWARD_SHARDS = int(os.environ.get('REWARD_SHARDS', '16'))
+REWARD_LEASE_SECONDS = int(os.environ.get('REWARD_LEASE_SECONDS', '60'))
+REWARD_WORKER_ID = f"{os.uname().nodename}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+owned_reward_shards = set()
+
+# Rewards are written ledger-first: each payout gets a deterministic transaction id per
+# (pass, stake) carrying a "pending" marker, then the stake and user are credited and the
+# marker removed. Replaying a pass therefore never records or credits a payout twice.
+# The stake update only matches while the stake's last_reward_date still equals the
+# entry's period_start, so two payouts of the same period (concurrent settles, a settle
+# racing a pass) cannot both land; the stake remembers its recent pass ids, which tells a
+# replayed entry that already landed from one that lost the race and is voided.
+# The user credit lists its entry ids in reward_credits and only matches while none of
+# them are there, so a replayed or taken-over batch credits each entry once; totals,
+# rollups and events follow the credits that matched. The ids are pulled again once
+# the entries are no longer pending.
+REWARD_PASS_STALE_SECONDS = int(os.environ.get('REWARD_PASS_STALE_SECONDS', str(REWARD_LEASE_SECONDS)))
+REWARD_PAID_PASS_MEMORY = int(os.environ.get('REWARD_PAID_PASS_MEMORY', '20'))
+
+def _unpaid_since(period_start):
+    """Match a stake whose last payout is still period_start"""
+    return {"$or": [
+        {"last_reward_date": period_start},
+        {"last_reward_date": {"$exists": False}, "start_date": period_start}
+    ]}
+
+async def _claim_reward_periods(entries):
+    """Move each entry's stake past its period and return the entries whose stake holds the payout"""
+    await db.stakes.bulk_write([
+        UpdateOne(
+            {"id": entry["stake_id"], **_unpaid_since(entry["period_start"])},
+            {
+                "$inc": {"total_earned": entry["amount"]},
+                "$set": {"last_reward_date": entry["created_at"]},
+                "$push": {"paid_passes": {"$each": [entry["pass_id"]], "$slice": -REWARD_PAID_PASS_MEMORY}}
+            }
+        )
+        for entry in entries
+    ], ordered=False)
+    
+    paid_passes = {
+        stake["id"]: stake.get("paid_passes", [])
+        async for stake in db.stakes.find(
+            {"id": {"$in": list({entry["stake_id"] for entry in entries})}},
+            {"_id": 0, "id": 1, "paid_passes": 1}
+        )
+    }
+    claimed = [entry for entry in entries if entry["pass_id"] in paid_passes.get(entry["stake_id"], ())]
+    if len(claimed) < len(entries):
+        claimed_ids = {entry["id"] for entry in claimed}
+        await _void_reward_entries([entry for entry in entries if entry["id"] not in claimed_ids])
+    return claimed
+
+async def _void_reward_entries(entries):
+    """Remove ledger entries for periods another payout already covered"""
+    transaction_ids = [entry["id"] for entry in entries if "bucket" not in entry]
+    if transaction_ids:
+        await db.transactions.delete_many({"id": {"$in": transaction_ids}, "pending": {"$exists": True}})
+    
+    bucketed = [entry for entry in entries if "bucket" in entry]
+    if bucketed:
+        await db.reward_buckets.bulk_write([
+            UpdateOne(
+                {"_id": entry["bucket"], "payouts.id": entry["id"]},
+                {"$pull": {"payouts": {"id": entry["id"]}}, "$inc": {"count": -1, "amount": -entry["amount"]}}
+            )
+            for entry in bucketed
+        ], ordered=False)
+
+async def _credit_reward_users(entries):
+    """Credit users for claimed entries and return the entries this call credited"""
+    by_user = {}
+    for entry in entries:
+        by_user.setdefault(entry["user_id"], []).append(entry)
+    
+    # Skip entries an earlier attempt already credited
+    async for user in db.users.find(
+        {"id": {"$in": list(by_user)}, "reward_credits": {"$in": [entry["id"] for entry in entries]}},
+        {"_id": 0, "id": 1, "reward_credits": 1}
+    ):
+        credited = set(user["reward_credits"])
+        by_user[user["id"]] = [entry for entry in by_user[user["id"]] if entry["id"] not in credited]
+    
+    async def credit(user_id, user_entries):
+        entry_ids = [entry["id"] for entry in user_entries]
+        amount = sum(entry["amount"] for entry in user_entries)
+        result = await db.users.update_one(
+            {"id": user_id, "reward_credits": {"$nin": entry_ids}},
+            {
+                "$inc": {
+                    "balance": amount,
+                    "total_rewards": amount,
+                    "stats.total_transactions": len(user_entries),
+                    "stats.reward_transactions": len(user_entries)
+                },
+                "$push": {"reward_credits": {"$each": entry_ids}}
+            }
+        )
+        return user_entries if result.modified_count else []
+    
+    credited = await asyncio.gather(*(
+        credit(user_id, user_entries) for user_id, user_entries in by_user.items() if user_entries
+    ))
+    return [entry for user_entries in credited for entry in user_entries]
+
+async def _apply_reward_entries(entries):
+    """Credit stakes and users for pending ledger entries; returns the amount and count credited"""
+    claimed = await _claim_reward_periods(entries) if entries else []
+    if not claimed:
+        return 0.0, 0
+    
+    credited = await _credit_reward_users(claimed)
+    user_increments = {}
+    user_payouts = {}
+    rollup_increments = {}
+    weighted_since = 0.0
+    for entry in credited:
+        now = entry["created_at"]
+        user_increments[entry["user_id"]] = user_increments.get(entry["user_id"], 0) + entry["amount"]
+        user_payouts[entry["user_id"]] = user_payouts.get(entry["user_id"], 0) + 1
+        _add_rollup_deltas(
+            rollup_increments, _rollup_day(now), entry["user_id"],
+            reward_count=1, rewards_distributed=entry["amount"], transaction_count=1
+        )
+        if entry["pending"]["prorated"]:
+            weighted_since += entry["amount"]
+        else:
+            weighted_since += entry["amount"] * (_accrual_days(now) - _accrual_days(entry["period_start"]))
+    
+    distributed = sum(user_increments.values())
+    if credited:
+        await _inc_platform_totals(
+            total_balance=distributed,
+            total_rewards=distributed,
+            accrual_weighted_since=weighted_since
+        )
+        await _inc_daily_rollups_bulk(rollup_increments)
+        await invalidate_cached_views(*user_increments)
+        await publish_user_events(*[
+            {
+                "type": "reward",
+                "user_id": user_id,
+                "amount": amount,
+                "count": user_payouts[user_id],
+                "changes": {"balance": amount, "total_rewards": amount},
+                "at": now
+            }
+            for user_id, amount in user_increments.items()
+        ])
+    await _clear_pending_rewards(claimed)
+    
+    credit_ids = {}
+    for entry in claimed:
+        credit_ids.setdefault(entry["user_id"], []).append(entry["id"])
+    await db.users.bulk_write([
+        UpdateOne({"id": user_id}, {"$pullAll": {"reward_credits": entry_ids}})
+        for user_id, entry_ids in credit_ids.items()
+    ], ordered=False)
+    return distributed, len(credited)
+
+async def _clear_pending_rewards(entries):
+    """Remove the pending marker from settled entries in whichever ledger holds them"""
+    transaction_ids = [entry["id"] for entry in entries if "bucket" not in entry]
+    if transaction_ids:
+        await db.transactions.update_many({"id": {"$in": transaction_ids}}, {"$unset": {"pending": ""}})
+    
+    buckets = {}
+    for entry in entries:
+        if "bucket" in entry:
+            buckets.setdefault(entry["bucket"], []).append(entry["id"])
+    if buckets:
+        await db.reward_buckets.bulk_write([
+            UpdateOne(
+                {"_id": bucket_id},
+                {"$unset": {"payouts.$[payout].pending": ""}},
+                array_filters=[{"payout.id": {"$in": payout_ids}}]
+            )
+            for bucket_id, payout_ids in buckets.items()
+        ], ordered=False)
+
+def _reward_bucket_id(user_id, moment):
+    return f"{user_id}:{_rollup_day(moment)}"
+
+# Fields of a ledger entry kept inside a bucket; user_id, type and status come from the bucket
+REWARD_PAYOUT_FIELDS = ("id", "stake_id", "pass_id", "amount", "created_at", "period_start", "pending")
+
+async def _record_reward_transactions(entries):
+    """Insert entries as transactions and return the ones not recorded by an earlier attempt"""
+    try:
+        await db.transactions.insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        errors = e.details.get("writeErrors", [])
+        if any(error["code"] != 11000 for error in errors):
+            raise
+        # Already recorded by an earlier attempt of this pass, which recovery settles
+        recorded = {entries[error["index"]]["id"] for error in errors}
+        entries = [entry for entry in entries if entry["id"] not in recorded]
+    return entries
+
+async def _record_reward_buckets(entries):
+    """Append entries to their user's daily bucket and return the ones not recorded before"""
+    for entry in entries:
+        entry["bucket"] = _reward_bucket_id(entry["user_id"], entry["created_at"])
+    
+    remaining = entries
+    for _ in range(3):
+        try:
+            await db.reward_buckets.bulk_write([
+                UpdateOne(
+                    {"_id": entry["bucket"], "payouts.id": {"$ne": entry["id"]}},
+                    {
+                        "$push": {"payouts": {field: entry[field] for field in REWARD_PAYOUT_FIELDS}},
+                        "$inc": {"count": 1, "amount": entry["amount"]},
+                        "$setOnInsert": {
+                            "user_id": entry["user_id"],
+                            "date": _rollup_day(entry["created_at"]),
+                            "day_start": entry["created_at"].replace(hour=0, minute=0, second=0, microsecond=0)
                         }
-                    )
-                    
-                    # Create transaction record
-                    transaction = {
-                        "id": str(uuid.uuid4()),
-                        "user_id": stake['user_id'],
-                        "type": "reward",
-                        "amount": daily_reward,
-                        "status": "completed",
-                        "created_at": now
-                    }
-                    db.transactions.insert_one(transaction)
-                    
-                    print(f"Distributed {daily_reward} USDT reward to user {stake['user_id']}")
-                    
+                    },
+                    upsert=True
+                )
+                for entry in remaining
+            ], ordered=False)
+            return entries
+        except BulkWriteError as e:
+            errors = e.details.get("writeErrors", [])
+            if any(error["code"] != 11000 for error in errors):
+                raise
+            # A duplicate key means the payout is already in the bucket, or another writer
+            # created the bucket first, in which case the append is simply retried
+            conflicted = [remaining[error["index"]] for error in errors]
+            recorded = {
+                payout["id"]
+                async for bucket in db.reward_buckets.find(
+                    {"payouts.id": {"$in": [entry["id"] for entry in conflicted]}},
+                    {"payouts.id": 1}
+                )
+                for payout in bucket["payouts"]
+            }
+            entries = [entry for entry in entries if entry["id"] not in recorded]
+            remaining = [entry for entry in conflicted if entry["id"] not in recorded]
+            if not remaining:
+                return entries
+    raise RuntimeError(f"Could not record {len(remaining)} reward payouts in their buckets")
+
+async def _flush_reward_batch(batch, now, pass_id, prorate=False):
+    """Apply one batch of rewards with a bulk write per collection"""
+    entries = []
+    for stake in batch:
+        rate = stake['amount'] * stake.get('daily_rate', 0.30)
+        daily_reward = _accrued_reward(stake, now) if prorate else rate
+        if daily_reward <= 0:
+            continue
+        entries.append({
+            "id": f"{pass_id}:{stake['id']}",
+            "user_id": stake['user_id'],
+            "type": "reward",
+            "amount": daily_reward,
+            "status": "completed",
+            "created_at": now,
+            "stake_id": stake['id'],
+            "pass_id": pass_id,
+            "period_start": _last_reward_date(stake),
+            "pending": {"prorated": prorate}
+        })
+    
+    if not entries:
+        return 0.0, 0
+    
+    if REWARD_LEDGER == "buckets":
+        entries = await _record_reward_buckets(entries)
+    else:
+        entries = await _record_reward_transactions(entries)
+    return await _apply_reward_entries(entries)
+
+def _expand_reward_buckets(payout_match):
+    """Pipeline stages turning bucketed payouts into transaction-shaped documents"""
+    return [
+        {"$unwind": "$payouts"},
+        {"$project": {
+            "_id": 0,
+            "user_id": 1,
+            "type": {"$literal": "reward"},
+            "status": {"$literal": "completed"},
+            "bucket": "$_id",
+            **{field: f"$payouts.{field}" for field in REWARD_PAYOUT_FIELDS}
+        }},
+        {"$match": payout_match}
+    ]
+
+async def _recover_pending_rewards(query):
+    """Finish ledger entries left pending by an interrupted pass, in either ledger"""
+    entries = await db.transactions.find(
+        {**query, "pending": {"$exists": True}},
+        {"_id": 0}
+    ).to_list(length=None)
+    entries += await db.reward_buckets.aggregate([
+        {"$match": {"payouts.pending": {"$exists": True}}},
+        *_expand_reward_buckets({**query, "pending": {"$exists": True}})
+    ]).to_list(length=None)
+    return await _apply_reward_entries(entries)
+
+def reward_bucket_payouts(user_id, start=None, end=None, position=None, limit=None):
+    """A user's bucketed reward payouts as transactions, newest first, from an optional keyset position"""
+    bucket_match = {"user_id": user_id}
+    payout_match = {}
+    if start:
+        bucket_match["day_start"] = {"$gte": start.replace(hour=0, minute=0, second=0, microsecond=0)}
+        payout_match["created_at"] = {"$gte": start}
+    if end:
+        bucket_match.setdefault("day_start", {})["$lt"] = end
+        payout_match.setdefault("created_at", {})["$lt"] = end
+    if position:
+        sort_value, doc_id = position
+        bucket_match.setdefault("day_start", {})["$lte"] = sort_value
+        payout_match["$or"] = [
+            {"created_at": {"$lt": sort_value}},
+            {"created_at": sort_value, "id": {"$lt": doc_id}}
+        ]
+    
+    pipeline = [{"$match": bucket_match}, {"$sort": {"day_start": -1}}]
+    if limit:
+        # Only the newest bucket can be partly past the position, so limit + 1 buckets hold enough
+        pipeline.append({"$limit": limit + 1})
+    pipeline += _expand_reward_buckets(payout_match)
+    pipeline += [{"$project": {"bucket": 0}}, {"$sort": {"created_at": -1, "id": -1}}]
+    if limit:
+        pipeline.append({"$limit": limit})
+    return db.reward_buckets.aggregate(pipeline, allowDiskUse=True)
+
+async def compact_reward_transactions(before=None):
+    """Move settled reward transactions into daily reward buckets in bulk, server-side"""
+    # The delete below re-runs the match, so it must not cover rows a pass can still write
+    # or settle after the aggregate read: stop at the start of the day (as of the stale
+    # horizon, which also covers unrecorded accrual settles) and before the start of any
+    # pass still running, whose rows are all created at that time
+    horizon = datetime.utcnow() - timedelta(seconds=REWARD_PASS_STALE_SECONDS)
+    cutoff = horizon.replace(hour=0, minute=0, second=0, microsecond=0)
+    if before:
+        cutoff = min(cutoff, before)
+    running = await db.reward_passes.find({"status": "running"}, {"now": 1}).sort("now", 1).limit(1).to_list(length=None)
+    if running:
+        cutoff = min(cutoff, running[0]["now"])
+    match = {"type": "reward", "pending": {"$exists": False}, "created_at": {"$lt": cutoff}}
+    payout = {field: f"${field}" for field in REWARD_PAYOUT_FIELDS if field != "pending"}
+    await db.transactions.aggregate([
+        {"$match": match},
+        {"$sort": {"created_at": 1}},
+        {"$group": {
+            "_id": {"user_id": "$user_id", "date": _day_of("$created_at")},
+            "payouts": {"$push": payout}
+        }},
+        {"$project": {
+            "_id": {"$concat": ["$_id.user_id", ":", "$_id.date"]},
+            "user_id": "$_id.user_id",
+            "date": "$_id.date",
+            "day_start": {"$dateFromString": {"dateString": "$_id.date"}},
+            "payouts": 1,
+            "count": {"$size": "$payouts"},
+            "amount": {"$sum": "$payouts.amount"}
+        }},
+        # Re-running after an interrupted delete must not append the same payouts twice
+        {"$merge": {
+            "into": "reward_buckets",
+            "on": "_id",
+            "whenMatched": [
+                {"$set": {"payouts": {"$concatArrays": ["$payouts", {"$filter": {
+                    "input": "$$new.payouts",
+                    "cond": {"$not": [{"$in": ["$$this.id", "$payouts.id"]}]}
+                }}]}}},
+                {"$set": {"count": {"$size": "$payouts"}, "amount": {"$sum": "$payouts.amount"}}}
+            ],
+            "whenNotMatched": "insert"
+        }}
+    ], allowDiskUse=True).to_list(length=None)
+    result = await db.transactions.delete_many(match)
+    return result.deleted_count
+
+async def settle_user_rewards(user_id, now, exclude_stake_id=None):
+    """Write out everything a user's active stakes have accrued so far"""
+    stakes = await db.stakes.find(
+        {"user_id": user_id, "is_active": True, "id": {"$ne": exclude_stake_id}},
+        REWARD_STAKE_PROJECTION
+    ).to_list(length=None)
+    return await _flush_reward_batch(stakes, now, f"settle-{uuid.uuid4()}", prorate=True)
+
+def _reward_due_interval():
+    return ACCRUAL_COMPACTION_AGE if REWARD_MODE == "accrual" else REWARD_INTERVAL
+
+async def distribute_rewards_pass(shards, stake_ids=None, batch_size=REWARD_BATCH_SIZE):
+    """Start a recorded reward pass over the due stakes of the given shards"""
+    now = datetime.utcnow()
+    record = {
+        "_id": str(uuid.uuid4()),
+        "worker": REWARD_WORKER_ID,
+        "mode": REWARD_MODE,
+        "shards": shards,
+        "stake_ids": stake_ids,
+        "now": now,
+        "cutoff": now - _reward_due_interval(),
+        "status": "running",
+        "started_at": now,
+        "heartbeat_at": now,
+        "checkpoint": None,
+        "stakes_scanned": 0,
+        "stakes_paid": 0,
+        "batches": 0,
+        "total_distributed": 0.0
+    }
+    await db.reward_passes.insert_one(record)
+    return await _run_reward_pass(record, batch_size)
+
+async def _run_reward_pass(record, batch_size=REWARD_BATCH_SIZE):
+    """Process a pass from its checkpoint onwards, checkpointing after every batch"""
+    started = time.monotonic()
+    now = record["now"]
+    cutoff = record["cutoff"]
+    prorate = record["mode"] == "accrual"
+    
+    # Only stakes whose last payout is older than the cutoff are streamed back
+    query = {
+        "shard": {"$in": record["shards"]},
+        "is_active": True,
+        "$or": [
+            {"last_reward_date": {"$lte": cutoff}},
+            {"last_reward_date": {"$exists": False}, "start_date": {"$lte": cutoff}}
+        ]
+    }
+    id_filter = {}
+    if record["stake_ids"] is not None:
+        id_filter["$in"] = record["stake_ids"]
+    if record["checkpoint"]:
+        id_filter["$gt"] = record["checkpoint"]
+    if id_filter:
+        query["id"] = id_filter
+    due_stakes = db.stakes.find(query, REWARD_STAKE_PROJECTION, batch_size=batch_size).sort("id", 1)
+    
+    progress = {
+        field: record[field]
+        for field in ("stakes_scanned", "stakes_paid", "batches", "total_distributed")
+    }
+    
+    async def flush(batch):
+        # Skipped, voided and already credited stakes are scanned but not paid
+        distributed, paid = await _flush_reward_batch(batch, now, record["_id"], prorate)
+        REWARD_STAKES_PAID.inc(paid)
+        REWARD_DISTRIBUTED.inc(distributed)
+        progress["total_distributed"] += distributed
+        progress["stakes_paid"] += paid
+        progress["batches"] += 1
+        await db.reward_passes.update_one(
+            {"_id": record["_id"]},
+            {"$set": {**progress, "checkpoint": batch[-1]["id"], "heartbeat_at": datetime.utcnow()}}
+        )
+    
+    batch = []
+    async for stake in due_stakes:
+        progress["stakes_scanned"] += 1
+        # Stop paying a shard as soon as its lease has moved to another worker
+        if stake.get("shard") not in owned_reward_shards:
+            continue
+        batch.append(stake)
+        if len(batch) >= batch_size:
+            await flush(batch)
+            batch = []
+    if batch:
+        await flush(batch)
+    
+    elapsed = time.monotonic() - started
+    REWARD_PASS_DURATION.labels(record["mode"]).observe(elapsed)
+    REWARD_STAKES_SCANNED.inc(progress["stakes_scanned"] - record["stakes_scanned"])
+    stats = {
+        **progress,
+        "elapsed_seconds": elapsed,
+        "stakes_per_second": progress["stakes_paid"] / elapsed if elapsed > 0 else 0
+    }
+    await db.reward_passes.update_one(
+        {"_id": record["_id"]},
+        {"$set": {**stats, "status": "completed", "finished_at": datetime.utcnow()}}
+    )
+    return stats
+
+async def resume_stale_reward_passes(shards):
+    """Take over passes whose worker stopped heartbeating and finish them from their checkpoint"""
+    stale_before = datetime.utcnow() - timedelta(seconds=REWARD_PASS_STALE_SECONDS)
+    
+    # Settlements outside a recorded pass (accrual settles) only need their pending entries finished
+    await _recover_pending_rewards({"created_at": {"$lt": stale_before}, "pass_id": {"$regex": "^settle-"}})
+    
+    resumed = []
+    async for record in db.reward_passes.find({
+        "status": "running",
+        "heartbeat_at": {"$lt": stale_before},
+        "shards": {"$in": shards}
+    }):
+        now = datetime.utcnow()
+        claimed = await db.reward_passes.find_one_and_update(
+            {"_id": record["_id"], "status": "running", "heartbeat_at": record["heartbeat_at"]},
+            {
+                "$set": {"worker": REWARD_WORKER_ID, "heartbeat_at": now, "resumed_at": now},
+                "$inc": {"resumes": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+        if not claimed:
+            continue
+        # The interrupted batch never reached a checkpoint, so what it leaves is counted here
+        distributed, paid = await _recover_pending_rewards({"pass_id": claimed["_id"]})
+        REWARD_STAKES_PAID.inc(paid)
+        REWARD_DISTRIBUTED.inc(distributed)
+        claimed["stakes_paid"] += paid
+        claimed["total_distributed"] += distributed
+        stats = await _run_reward_pass(claimed)
+        print(f"Resumed reward pass {claimed['_id']} from checkpoint {record['checkpoint']}: {stats}")
+        resumed.append(claimed["_id"])
+    return resumed
+
+# Stakes are partitioned into shards by a hash of their id (see _stake_shard)
+
+def _stake_shard(stake_id):
+    return zlib.crc32(stake_id.encode()) % REWARD_SHARDS
+
+async def assign_missing_stake_shards(batch_size=REWARD_BATCH_SIZE):
+    """Backfill the shard of stakes created before sharding existed"""
+    updates = []
+    async for stake in db.stakes.find({"shard": {"$exists": False}}, {"_id": 0, "id": 1}):
+        updates.append(UpdateOne({"id": stake["id"]}, {"$set": {"shard": _stake_shard(stake["id"])}}))
+        if len(updates) >= batch_size:
+            await db.stakes.bulk_write(updates, ordered=False)
+            updates = []
+    if updates:
+        await db.stakes.bulk_write(updates, ordered=False)
+
+async def _acquire_reward_leases():
+    """Heartbeat, renew our leases and converge on a fair share of the shards"""
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=REWARD_LEASE_SECONDS)
+    
+    await db.reward_workers.update_one(
+        {"_id": REWARD_WORKER_ID},
+        {"$set": {"heartbeat_at": now}},
+        upsert=True
+    )
+    live_workers = await db.reward_workers.count_documents(
+        {"heartbeat_at": {"$gt": now - timedelta(seconds=REWARD_LEASE_SECONDS)}}
+    )
+    fair_share = math.ceil(REWARD_SHARDS / max(live_workers, 1))
+    
+    await db.reward_leases.update_many(
+        {"owner": REWARD_WORKER_ID},
+        {"$set": {"expires_at": expires_at}}
+    )
+    owned = sorted([lease["_id"] async for lease in db.reward_leases.find({"owner": REWARD_WORKER_ID})])
+    
+    # Hand surplus shards back so workers that just joined can pick them up
+    if len(owned) > fair_share:
+        surplus = owned[fair_share:]
+        owned = owned[:fair_share]
+        await db.reward_leases.update_many(
+            {"_id": {"$in": surplus}, "owner": REWARD_WORKER_ID},
+            {"$set": {"owner": None, "expires_at": now}}
+        )
+    
+    free_shards = [shard for shard in range(REWARD_SHARDS) if shard not in owned]
+    random.shuffle(free_shards)
+    for shard in free_shards:
+        if len(owned) >= fair_share:
+            break
+        try:
+            lease = await db.reward_leases.find_one_and_update(
+                {"_id": shard, "$or": [{"owner": None}, {"expires_at": {"$lt": now}}]},
+                {"$set": {"owner": REWARD_WORKER_ID, "expires_at": expires_at, "acquired_at": now}},
+                upsert=True,
+                return_document=ReturnDocument.AFTER
+            )
+        except DuplicateKeyError:
+            # Another live worker holds this shard
+            continue
+        if lease and lease["owner"] == REWARD_WORKER_ID:
+            owned.append(shard)
+    
+    return set(owned)
+
+async def maintain_reward_leases():
+    """Keep this worker's shard leases alive and rebalanced"""
+    while True:
+        try:
+            shards = await _acquire_reward_leases()
+            if shards != owned_reward_shards:
+                print(f"Reward worker {REWARD_WORKER_ID} now owns shards {sorted(shards)}")
+            owned_reward_shards.clear()
+            owned_reward_shards.update(shards)
         except Exception as e:
-            print(f"Error calculating rewards: {e}")
+            print(f"Error maintaining reward leases: {e}")
+        
+        await asyncio.sleep(REWARD_LEASE_SECONDS / 3)
+
+async def release_reward_leases():
+    """Give up our shards on shutdown so they are reassigned without waiting for expiry"""
+    owned_reward_shards.clear()
+    await db.reward_leases.update_many(
+        {"owner": REWARD_WORKER_ID},
+        {"$set": {"owner": None, "expires_at": datetime.utcnow()}}
+    )
+    await db.reward_workers.delete_one({"_id": REWARD_WORKER_ID})
+
+# Due-time scheduler: a min-heap of (due time, stake id) for the owned shards, so the
+# reward loop sleeps until the next payout instead of polling and rescanning every hour
+REWARD_SCHEDULER_SYNC_SECONDS = int(os.environ.get('REWARD_SCHEDULER_SYNC_SECONDS', '60'))
+# Due times are spread across the day, so a wakeup waits until the earliest due stake is
+# this late and then pays everything due by then in one pass, instead of one per stake
+REWARD_SCHEDULER_COALESCE_SECONDS = int(os.environ.get('REWARD_SCHEDULER_COALESCE_SECONDS', '300'))
+
+class RewardScheduler:
+    """In-memory payout schedule for this worker's shards"""
+    
+    def __init__(self):
+        self.heap = []
+        self.due_at = {}
+        self.shards = set()
+        self.synced_at = None
+        self.started = False
+        self.wakeup = asyncio.Event()
+        self.stats = {
+            "wakeups": 0,
+            "heap_size": 0,
+            "last_scan_size": 0,
+            "last_paid": 0,
+            "last_lateness_avg_seconds": 0.0,
+            "last_lateness_max_seconds": 0.0
+        }
+    
+    def schedule(self, stake_id, shard, due):
+        """Insert or move a stake's next payout; stale heap entries are skipped lazily"""
+        if shard not in self.shards:
+            return
+        self.due_at[stake_id] = due
+        heapq.heappush(self.heap, (due, stake_id))
+        if self.heap[0][1] == stake_id:
+            self.wakeup.set()
+    
+    def cancel(self, stake_id):
+        self.due_at.pop(stake_id, None)
+    
+    async def _load(self, query, not_before=None):
+        interval = _reward_due_interval()
+        async for stake in db.stakes.find(query, {"_id": 0, "id": 1, "shard": 1, "start_date": 1, "last_reward_date": 1}):
+            due = _last_reward_date(stake) + interval
+            self.schedule(stake["id"], stake["shard"], max(due, not_before) if not_before else due)
+    
+    async def rebuild(self, shards):
+        """Reload the schedule from the (shard, is_active, last_reward_date) index"""
+        if shards:
+            await resume_stale_reward_passes(sorted(shards))
+        self.heap = []
+        self.due_at = {}
+        self.shards = set(shards)
+        self.synced_at = datetime.utcnow()
+        await self._load({"shard": {"$in": sorted(shards)}, "is_active": True})
+    
+    async def sync(self):
+        """Pick up stakes created or settled by other processes since the last sync"""
+        since = self.synced_at
+        self.synced_at = datetime.utcnow()
+        # Passes interrupted in steady state (a failed batch, a quick restart) are taken
+        # over here too, not only when the owned shards change
+        if self.shards and await resume_stale_reward_passes(sorted(self.shards)):
+            # Their stakes were popped when they fell due, so the schedule is reloaded
+            await self._load({"shard": {"$in": sorted(self.shards)}, "is_active": True})
+            return
+        await self._load({
+            "shard": {"$in": sorted(self.shards)},
+            "is_active": True,
+            "last_reward_date": {"$gte": since - timedelta(seconds=REWARD_SCHEDULER_SYNC_SECONDS)}
+        })
+    
+    def _pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now:
+            due_time, stake_id = heapq.heappop(self.heap)
+            if self.due_at.get(stake_id) == due_time:
+                del self.due_at[stake_id]
+                due.append((due_time, stake_id))
+        return due
+    
+    def _next_due(self):
+        while self.heap and self.due_at.get(self.heap[0][1]) != self.heap[0][0]:
+            heapq.heappop(self.heap)
+        return self.heap[0][0] if self.heap else None
+    
+    async def _process(self, due, now):
+        stake_ids = [stake_id for _, stake_id in due]
+        lateness = [(now - due_time).total_seconds() for due_time, _ in due]
+        paid = 0
+        distributed = 0.0
+        for i in range(0, len(stake_ids), REWARD_BATCH_SIZE):
+            chunk = stake_ids[i:i + REWARD_BATCH_SIZE]
+            result = await distribute_rewards_pass(sorted(self.shards), stake_ids=chunk)
+            paid += result["stakes_paid"]
+            distributed += result["total_distributed"]
+            # Re-arm every stake from its stored payout date; one the pass did not pay
+            # (nothing accrued, or its period already paid elsewhere) waits a full interval
+            # instead of falling due again immediately
+            await self._load({"id": {"$in": chunk}, "is_active": True}, not_before=now + _reward_due_interval())
+        
+        self.stats.update({
+            "last_scan_size": len(stake_ids),
+            "last_paid": paid,
+            "last_lateness_avg_seconds": sum(lateness) / len(lateness),
+            "last_lateness_max_seconds": max(lateness)
+        })
+        print(
+            f"Reward wakeup: {paid}/{len(stake_ids)} due stakes paid, {distributed} USDT, "
+            f"lateness avg {self.stats['last_lateness_avg_seconds']:.1f}s max {self.stats['last_lateness_max_seconds']:.1f}s"
+        )
+    
+    async def run(self):
+        self.started = True
+        while True:
+            try:
+                if self.synced_at is None or set(owned_reward_shards) != self.shards:
+                    await self.rebuild(owned_reward_shards)
+                elif (datetime.utcnow() - self.synced_at).total_seconds() >= REWARD_SCHEDULER_SYNC_SECONDS:
+                    await self.sync()
+                
+                now = datetime.utcnow()
+                next_due = self._next_due()
+                window = timedelta(seconds=REWARD_SCHEDULER_COALESCE_SECONDS)
+                if next_due is not None and next_due + window <= now:
+                    self.stats["wakeups"] += 1
+                    await self._process(self._pop_due(now), now)
+                    continue
+                
+                self.stats["heap_size"] = len(self.due_at)
+                REWARD_SCHEDULED_STAKES.set(len(self.due_at))
+                timeout = REWARD_SCHEDULER_SYNC_SECONDS
+                if next_due is not None:
+                    timeout = min(timeout, max((next_due + window - now).total_seconds(), 0))
+            except Exception as e:
+                print(f"Error in reward scheduler: {e}")
+                timeout = REWARD_SCHEDULER_SYNC_SECONDS
             
-        # Wait 1 hour before next check
-        await asyncio.sleep(3600)
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+reward_scheduler = RewardScheduler()
+
+# Background task for calculating daily rewards
+async def calculate_daily_rewards():
+    """Pay rewards for the stakes in this worker's shards as they fall due"""
+    try:
+        await assign_missing_stake_shards()
+    except Exception as e:
+        print(f"Error assigning stake shards: {e}")
+    
+    await reward_scheduler.run()
+
+# Durable payment callback queue, stored in Mongo and drained by background workers
+PAYMENT_QUEUE_WORKERS = int(os.environ.get('PAYMENT_QUEUE_WORKERS', '1'))
+PAYMENT_QUEUE_BATCH_SIZE = int(os.environ.get('PAYMENT_QUEUE_BATCH_SIZE', '100'))
+PAYMENT_QUEUE_POLL_INTERVAL = float(os.environ.get('PAYMENT_QUEUE_POLL_INTERVAL', '1'))
+PAYMENT_QUEUE_LEASE_SECONDS = int(os.environ.get('PAYMENT_QUEUE_LEASE_SECONDS', '60'))
+
+payment_queue_wakeup = asyncio.Event()
+payment_queue_stats = {"processed": 0, "credited": 0, "credited_amount": 0.0, "batches": 0}
+
+async def enqueue_payment_callback(payment_id, payment_status, payload):
+    """Store a gateway callback once per payment and status"""
+    await db.payment_callbacks.update_one(
+        {"_id": f"{payment_id}:{payment_status}"},
+        {"$setOnInsert": {
+            "payment_id": payment_id,
+            "payment_status": payment_status,
+            "payload": payload,
+            "status": "queued",
+            "attempts": 0,
+            "received_at": datetime.utcnow()
+        }},
+        upsert=True
+    )
+    payment_queue_wakeup.set()
+
+async def _claim_payment_callbacks(worker_id, limit):
+    """Lease up to limit queued callbacks, including ones abandoned by a dead worker"""
+    jobs = []
+    for _ in range(limit):
+        now = datetime.utcnow()
+        job = await db.payment_callbacks.find_one_and_update(
+            {"$or": [
+                {"status": "queued"},
+                {"status": "processing", "lease_expires_at": {"$lt": now}}
+            ]},
+            {
+                "$set": {
+                    "status": "processing",
+                    "worker": worker_id,
+                    "lease_expires_at": now + timedelta(seconds=PAYMENT_QUEUE_LEASE_SECONDS)
+                },
+                "$inc": {"attempts": 1}
+            },
+            sort=[("received_at", 1)],
+            return_document=ReturnDocument.AFTER
+        )
+        if not job:
+            break
+        jobs.append(job)
+    return jobs
+
+async def _process_payment_callbacks(jobs):
+    """Complete finished payments exactly once and credit balances"""
+    now = datetime.utcnow()
+    # A finished deposit moves pending -> crediting -> completed. A job retried after a
+    # crash picks up deposits left in crediting, and the user credit lists the deposit id
+    # in deposit_credits and only matches while it is absent, so each deposit is credited
+    # exactly once however often the job runs.
+    deposits = []
+    for job in jobs:
+        if job["payment_status"] != "finished":
+            continue
+        transaction = await db.transactions.find_one_and_update(
+            {"payment_id": job["payment_id"], "status": {"$in": ["pending", "crediting"]}},
+            {"$set": {"status": "crediting"}}
+        )
+        if transaction:
+            deposits.append(transaction)
+    
+    async def credit(transaction):
+        # Guarded per deposit, so one already credited cannot block a new one for the same user
+        result = await db.users.update_one(
+            {"id": transaction["user_id"], "deposit_credits": {"$ne": transaction["id"]}},
+            {"$inc": {"balance": transaction["amount"]}, "$push": {"deposit_credits": transaction["id"]}}
+        )
+        return result.modified_count > 0
+    
+    results = await asyncio.gather(*(credit(transaction) for transaction in deposits))
+    credited = [transaction for transaction, ok in zip(deposits, results) if ok]
+    credits = {}
+    rollup_increments = {}
+    for transaction in credited:
+        credits[transaction["user_id"]] = credits.get(transaction["user_id"], 0) + transaction["amount"]
+        _add_rollup_deltas(
+            rollup_increments, _rollup_day(now), transaction["user_id"],
+            deposits=1, deposit_amount=transaction["amount"]
+        )
+    
+    if credits:
+        await _inc_platform_totals(total_balance=sum(credits.values()))
+        await _inc_daily_rollups_bulk(rollup_increments)
+        await invalidate_cached_views(*credits)
+        await publish_user_events(*[
+            {"type": "deposit.completed", "user_id": user_id, "amount": amount, "changes": {"balance": amount}, "at": now}
+            for user_id, amount in credits.items()
+        ])
+    
+    if deposits:
+        # Only deposits listed on their user, credited by this call or an earlier one, complete
+        listed = {
+            deposit_id
+            async for user in db.users.find(
+                {"id": {"$in": list({transaction["user_id"] for transaction in deposits})}},
+                {"_id": 0, "deposit_credits": 1}
+            )
+            for deposit_id in user.get("deposit_credits", [])
+        }
+        completed = {}
+        for transaction in deposits:
+            if transaction["id"] in listed:
+                completed.setdefault(transaction["user_id"], []).append(transaction["id"])
+        if completed:
+            await db.transactions.update_many(
+                {"id": {"$in": [deposit_id for ids in completed.values() for deposit_id in ids]}, "status": "crediting"},
+                {"$set": {"status": "completed", "completed_at": now}}
+            )
+            await db.users.bulk_write([
+                UpdateOne({"id": user_id}, {"$pullAll": {"deposit_credits": ids}})
+                for user_id, ids in completed.items()
+            ], ordered=False)
+    
+    await db.payment_callbacks.update_many(
+        {"_id": {"$in": [job["_id"] for job in jobs]}},
+        {"$set": {"status": "done", "processed_at": now}, "$unset": {"lease_expires_at": ""}}
+    )
+    
+    payment_queue_stats["processed"] += len(jobs)
+    payment_queue_stats["credited"] += len(credits)
+    payment_queue_stats["credited_amount"] += sum(credits.values())
+    payment_queue_stats["batches"] += 1
+
+async def process_payment_callbacks(worker_id):
+    """Background worker draining the payment callback queue"""
+    while True:
+        try:
+            jobs = await _claim_payment_callbacks(worker_id, PAYMENT_QUEUE_BATCH_SIZE)
+            if jobs:
+                await _process_payment_callbacks(jobs)
+                continue
+        except Exception as e:
+            print(f"Error processing payment callbacks: {e}")
+        
+        payment_queue_wakeup.clear()
+        try:
+            await asyncio.wait_for(payment_queue_wakeup.wait(), PAYMENT_QUEUE_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+async def get_payment_queue_metrics():
+    """Queue depth, processing lag and worker counters for the payment callback queue"""
+    depth = await db.payment_callbacks.count_documents({"status": {"$in": ["queued", "processing"]}})
+    oldest = await db.payment_callbacks.find_one(
+        {"status": {"$in": ["queued", "processing"]}},
+        {"received_at": 1},
+        sort=[("received_at", 1)]
+    )
+    lag = (datetime.utcnow() - oldest["received_at"]).total_seconds() if oldest else 0
+    return {"depth": depth, "lag_seconds": lag, **payment_queue_stats}
+
+# Prometheus metrics; set PROMETHEUS_MULTIPROC_DIR when running several uvicorn workers
+PROMETHEUS_MULTIPROC_DIR = os.environ.get('PROMETHEUS_MULTIPROC_DIR')
+
+REQUEST_LATENCY = Histogram(
+    "http_request_duration_seconds", "HTTP request latency by route",
+    ["method", "route", "status"]
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "http_requests_in_flight", "HTTP requests currently being served by route",
+    ["method", "route"], multiprocess_mode="livesum"
+)
+MONGO_COMMAND_LATENCY = Histogram(
+    "mongo_command_duration_seconds", "MongoDB command latency by collection and command",
+    ["collection", "command"]
+)
+MONGO_COMMAND_DOCUMENTS = Counter(
+    "mongo_command_documents_total", "Documents returned or written by MongoDB commands",
+    ["collection", "command"]
+)
+MONGO_COMMAND_FAILURES = Counter(
+    "mongo_command_failures_total", "Failed MongoDB commands",
+    ["collection", "command"]
+)
+PAYMENT_GATEWAY_LATENCY = Histogram(
+    "payment_gateway_request_duration_seconds", "NOWPayments call latency by outcome",
+    ["path", "outcome"]
+)
+REWARD_PASS_DURATION = Histogram(
+    "reward_pass_duration_seconds", "Reward pass duration",
+    ["mode"], buckets=(0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 900)
+)
+REWARD_STAKES_SCANNED = Counter("reward_stakes_scanned_total", "Due stakes streamed by reward passes")
+REWARD_STAKES_PAID = Counter("reward_stakes_paid_total", "Stakes paid by reward passes")
+REWARD_DISTRIBUTED = Counter("reward_distributed_total", "USDT credited by reward passes")
+REWARD_SCHEDULED_STAKES = Gauge(
+    "reward_scheduled_stakes", "Stakes in this worker's payout schedule",
+    multiprocess_mode="livesum"
+)
+
+class MongoCommandMetrics(monitoring.CommandListener):
+    """Record per-collection, per-command latency and document counts from the driver"""
+    
+    def __init__(self):
+        self.pending = {}
+    
+    def started(self, event):
+        target = event.command.get("collection" if event.command_name == "getMore" else event.command_name)
+        self.pending[(event.connection_id, event.request_id)] = target if isinstance(target, str) else "-"
+    
+    def succeeded(self, event):
+        collection = self.pending.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        cursor = event.reply.get("cursor")
+        if cursor:
+            documents = len(cursor.get("firstBatch", cursor.get("nextBatch", [])))
+        else:
+            documents = event.reply.get("n", 0)
+        if documents:
+            MONGO_COMMAND_DOCUMENTS.labels(collection, event.command_name).inc(documents)
+    
+    def failed(self, event):
+        collection = self.pending.pop((event.connection_id, event.request_id), "-")
+        MONGO_COMMAND_LATENCY.labels(collection, event.command_name).observe(event.duration_micros / 1e6)
+        MONGO_COMMAND_FAILURES.labels(collection, event.command_name).inc()
+
+mongo_command_metrics = MongoCommandMetrics()
+
+def _route_template(scope):
+    """Resolve the route path template so user ids do not become label values"""
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+# Startup state reported by /readyz; the connection is warmed in the background so the
+# process answers /healthz immediately even while MongoDB is still coming up
+MONGO_WARMUP_MAX_BACKOFF = float(os.environ.get('MONGO_WARMUP_MAX_BACKOFF', '5'))
+READINESS_PING_TIMEOUT = float(os.environ.get('READINESS_PING_TIMEOUT', '2'))
+
+startup_state = {"mongo_connected": False, "indexes_ready": False}
+
+async def warm_up():
+    """Open the Mongo connection pool as soon as the server is reachable, then ensure indexes"""
+    backoff = 0.1
+    while True:
+        try:
+            await db.command("ping")
+            break
+        except Exception as e:
+            print(f"Waiting for MongoDB: {e}")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, MONGO_WARMUP_MAX_BACKOFF)
+    startup_state["mongo_connected"] = True
+    
+    await ensure_indexes()
+    startup_state["indexes_ready"] = True
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Start background task
-    task = asyncio.create_task(calculate_daily_rewards())
+    await payment_gateway.start()
+    await response_cache.start()
+    await event_broadcaster.start()
+    
+    # Start background tasks
+    tasks = [
+        asyncio.create_task(warm_up()),
+        asyncio.create_task(maintain_reward_leases()),
+        asyncio.create_task(calculate_daily_rewards()),
+        asyncio.create_task(reconcile_platform_totals_periodically()),
+        asyncio.create_task(publish_platform_ticker())
+    ]
+    worker_prefix = f"{os.uname().nodename}:{os.getpid()}"
+    for i in range(PAYMENT_QUEUE_WORKERS):
+        tasks.append(asyncio.create_task(process_payment_callbacks(f"{worker_prefix}:{i}")))
     yield
     # Cleanup
-    task.cancel()
+    for task in tasks:
+        task.cancel()
+    await release_reward_leases()
+    await payment_gateway.close()
+    await response_cache.close()
+    await event_broadcaster.close()
 
-app = FastAPI(lifespan=lifespan)
+# orjson encodes datetimes natively; hot endpoints return ORJSONResponse directly so the
+# stored documents skip jsonable_encoder, their response_model only documents the shape
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
 
 # CORS configuration
 app.add_middleware(
@@ -124,26 +1599,464 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
-# MongoDB connection
+@app.middleware("http")
+async def record_request_metrics(request, call_next):
+    route = _route_template(request.scope)
+    in_flight = REQUESTS_IN_FLIGHT.labels(request.method, route)
+    in_flight.inc()
+    started = time.monotonic()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        in_flight.dec()
+        REQUEST_LATENCY.labels(request.method, route, str(status)).observe(time.monotonic() - started)
+
+# MongoDB connection (async driver, so queries never block the event loop)
 mongo_url = os.environ.get('MONGO_URL', 'mongodb://localhost:27017')
-client = MongoClient(mongo_url)
+MONGO_MAX_POOL_SIZE = int(os.environ.get('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.environ.get('MONGO_MIN_POOL_SIZE', '0'))
+client = AsyncIOMotorClient(
+    mongo_url,
+    maxPoolSize=MONGO_MAX_POOL_SIZE,
+    minPoolSize=MONGO_MIN_POOL_SIZE,
+    event_listeners=[mongo_command_metrics]
+)
 db = client.usdt_staking_db
 
 # NOWPayments configuration
-NOWPAYMENTS_API_KEY = "9P6G10G-HKS4CD5-NK7R625-AH7JCKC"
-NOWPAYMENTS_BASE_URL = "https://api-sandbox.nowpayments.io/v1"
+NOWPAYMENTS_API_KEY = os.environ.get('NOWPAYMENTS_API_KEY', "9P6G10G-HKS4CD5-NK7R625-AH7JCKC")
+NOWPAYMENTS_BASE_URL = os.environ.get('NOWPAYMENTS_BASE_URL', "https://api-sandbox.nowpayments.io/v1")
+PAYMENT_GATEWAY_CONNECT_TIMEOUT = float(os.environ.get('PAYMENT_GATEWAY_CONNECT_TIMEOUT', '5'))
+PAYMENT_GATEWAY_READ_TIMEOUT = float(os.environ.get('PAYMENT_GATEWAY_READ_TIMEOUT', '15'))
+PAYMENT_GATEWAY_MAX_CONNECTIONS = int(os.environ.get('PAYMENT_GATEWAY_MAX_CONNECTIONS', '20'))
+PAYMENT_GATEWAY_MAX_CONCURRENCY = int(os.environ.get('PAYMENT_GATEWAY_MAX_CONCURRENCY', '10'))
+PAYMENT_GATEWAY_MAX_RETRIES = int(os.environ.get('PAYMENT_GATEWAY_MAX_RETRIES', '3'))
+PAYMENT_GATEWAY_BACKOFF = float(os.environ.get('PAYMENT_GATEWAY_BACKOFF', '0.25'))
+
+class PaymentGatewayClient:
+    """Pooled keep-alive client for the NOWPayments API with bounded concurrency and retries"""
+    
+    # The gateway did not process these requests, so resending cannot create a duplicate payment
+    RETRYABLE_STATUS = {429, 503}
+    RETRYABLE_ERRORS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout)
+    
+    def __init__(self, base_url, api_key):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.client = None
+        self.semaphore = asyncio.Semaphore(PAYMENT_GATEWAY_MAX_CONCURRENCY)
+        self.latencies = deque(maxlen=1000)
+        self.requests = 0
+        self.failures = 0
+        self.retries = 0
+    
+    async def start(self):
+        self.client = httpx.AsyncClient(
+            base_url=self.base_url,
+            headers={"x-api-key": self.api_key, "Content-Type": "application/json"},
+            timeout=httpx.Timeout(
+                PAYMENT_GATEWAY_READ_TIMEOUT,
+                connect=PAYMENT_GATEWAY_CONNECT_TIMEOUT
+            ),
+            limits=httpx.Limits(
+                max_connections=PAYMENT_GATEWAY_MAX_CONNECTIONS,
+                max_keepalive_connections=PAYMENT_GATEWAY_MAX_CONNECTIONS
+            )
+        )
+    
+    async def close(self):
+        if self.client:
+            await self.client.aclose()
+            self.client = None
+    
+    async def post(self, path, payload):
+        """POST to the gateway, retrying with jittered backoff only when nothing was processed"""
+        if self.client is None:
+            await self.start()
+        
+        async with self.semaphore:
+            for attempt in range(PAYMENT_GATEWAY_MAX_RETRIES + 1):
+                started = time.monotonic()
+                self.requests += 1
+                try:
+                    response = await self.client.post(path, json=payload)
+                except self.RETRYABLE_ERRORS:
+                    PAYMENT_GATEWAY_LATENCY.labels(path, "connect_error").observe(time.monotonic() - started)
+                    self.failures += 1
+                    if attempt == PAYMENT_GATEWAY_MAX_RETRIES:
+                        raise
+                else:
+                    self.latencies.append(time.monotonic() - started)
+                    PAYMENT_GATEWAY_LATENCY.labels(path, str(response.status_code)).observe(self.latencies[-1])
+                    if response.status_code not in self.RETRYABLE_STATUS or attempt == PAYMENT_GATEWAY_MAX_RETRIES:
+                        if response.status_code >= 400:
+                            self.failures += 1
+                        return response
+                    self.failures += 1
+                
+                self.retries += 1
+                await asyncio.sleep(random.uniform(0, PAYMENT_GATEWAY_BACKOFF * 2 ** attempt))
+    
+    def stats(self):
+        latencies = sorted(self.latencies)
+        
+        def percentile(fraction):
+            return latencies[min(len(latencies) - 1, int(len(latencies) * fraction))] if latencies else 0
+        
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "retries": self.retries,
+            "latency_p50": percentile(0.50),
+            "latency_p95": percentile(0.95),
+            "latency_p99": percentile(0.99)
+        }
+
+payment_gateway = PaymentGatewayClient(NOWPAYMENTS_BASE_URL, NOWPAYMENTS_API_KEY)
+
+# Response cache for the analytics endpoints, bounded by size and TTL. With REDIS_URL set the
+# entries live in Redis so every worker shares them and sees the others' invalidations
+RESPONSE_CACHE_TTL = float(os.environ.get('RESPONSE_CACHE_TTL', '30'))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+REDIS_URL = os.environ.get('REDIS_URL')
+
+class ResponseCache:
+    """TTL LRU of computed responses grouped by scope, with single-flight loading"""
+    
+    def __init__(self, ttl, max_entries, redis_url=None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.redis_url = redis_url
+        self.redis = None
+        self.entries = OrderedDict()
+        self.scopes = {}
+        self.inflight = {}
+        self.stale = set()
+        self.counters = {
+            "hits": 0, "misses": 0, "coalesced": 0, "evictions": 0,
+            "expirations": 0, "invalidations": 0, "errors": 0
+        }
+    
+    async def start(self):
+        if self.redis_url:
+            import redis.asyncio as redis
+            self.redis = redis.from_url(self.redis_url)
+    
+    async def close(self):
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+    
+    async def get_or_load(self, scope, field, loader):
+        """Return the cached value or compute it once, however many callers miss together"""
+        key = (scope, field)
+        found, value = await self._get(key)
+        if found:
+            self.counters["hits"] += 1
+            return value
+        
+        task = self.inflight.get(key)
+        if task is None:
+            self.counters["misses"] += 1
+            task = self.inflight[key] = asyncio.ensure_future(self._load(key, loader))
+        else:
+            self.counters["coalesced"] += 1
+        return await asyncio.shield(task)
+    
+    async def invalidate(self, *scopes):
+        """Drop every cached view of the given scopes"""
+        for scope in scopes:
+            for field in self.scopes.pop(scope, ()):
+                self.entries.pop((scope, field), None)
+        # A load already running read the old state, so it must not store its result
+        self.stale.update(key for key in self.inflight if key[0] in scopes)
+        self.counters["invalidations"] += len(scopes)
+        
+        if self.redis is not None and scopes:
+            try:
+                await self.redis.delete(*[f"cache:{scope}" for scope in scopes])
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"Error invalidating cache: {e}")
+    
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+            if key not in self.stale:
+                await self._set(key, value)
+            return value
+        finally:
+            self.inflight.pop(key, None)
+            self.stale.discard(key)
+    
+    async def _get(self, key):
+        if self.redis is not None:
+            try:
+                cached = await self.redis.hget(f"cache:{key[0]}", key[1])
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"Error reading cache: {e}")
+                return False, None
+            if cached is None:
+                return False, None
+            entry = json.loads(cached)
+            if time.time() >= entry["expires_at"]:
+                self.counters["expirations"] += 1
+                return False, None
+            return True, entry["value"]
+        
+        entry = self.entries.get(key)
+        if entry is None:
+            return False, None
+        expires_at, value = entry
+        if time.monotonic() >= expires_at:
+            self._drop(key)
+            self.counters["expirations"] += 1
+            return False, None
+        self.entries.move_to_end(key)
+        return True, value
+    
+    async def _set(self, key, value):
+        if self.redis is not None:
+            name = f"cache:{key[0]}"
+            entry = json.dumps({"expires_at": time.time() + self.ttl, "value": value}, default=_json_default)
+            try:
+                await self.redis.hset(name, key[1], entry)
+                await self.redis.expire(name, int(math.ceil(self.ttl)))
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"Error writing cache: {e}")
+            return
+        
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        self.scopes.setdefault(key[0], set()).add(key[1])
+        while len(self.entries) > self.max_entries:
+            self._drop(next(iter(self.entries)))
+            self.counters["evictions"] += 1
+    
+    def _drop(self, key):
+        self.entries.pop(key, None)
+        fields = self.scopes.get(key[0])
+        if fields is not None:
+            fields.discard(key[1])
+            if not fields:
+                del self.scopes[key[0]]
+    
+    def stats(self):
+        lookups = self.counters["hits"] + self.counters["misses"] + self.counters["coalesced"]
+        return {
+            **self.counters,
+            "hit_rate": self.counters["hits"] / lookups if lookups else 0,
+            "entries": len(self.entries),
+            "inflight": len(self.inflight),
+            "backend": "redis" if self.redis is not None else "memory",
+            "ttl_seconds": self.ttl,
+            "max_entries": self.max_entries
+        }
+
+response_cache = ResponseCache(RESPONSE_CACHE_TTL, RESPONSE_CACHE_MAX_ENTRIES, REDIS_URL)
+
+async def invalidate_cached_views(*user_ids):
+    """Drop cached analytics for the platform and the given users after a write"""
+    await response_cache.invalidate("platform", *[f"user:{user_id}" for user_id in user_ids])
+
+# Push channel: write paths publish small events to "user:<id>" channels and a ticker publishes
+# platform stats to "platform". Each event is encoded once as an SSE frame and the same bytes
+# go to every subscriber queue, so fan-out costs no database reads. With REDIS_URL set,
+# events travel through Redis pub/sub so subscribers on any worker receive them
+EVENT_QUEUE_SIZE = int(os.environ.get('EVENT_QUEUE_SIZE', '100'))
+EVENT_HEARTBEAT_SECONDS = float(os.environ.get('EVENT_HEARTBEAT_SECONDS', '15'))
+PLATFORM_TICKER_INTERVAL = float(os.environ.get('PLATFORM_TICKER_INTERVAL', '5'))
+EVENT_BACKPLANE_URL = os.environ.get('EVENT_BACKPLANE_URL', REDIS_URL)
+
+def _sse_frame(event):
+    return b"data: " + orjson.dumps(event) + b"\n\n"
+
+USER_BALANCE_PROJECTION = {"_id": 0, "balance": 1, "staked_amount": 1, "total_rewards": 1}
+SSE_KEEPALIVE = b": keepalive\n\n"
+# Sent instead of the backlog to a subscriber that fell behind, telling it to reload
+SSE_RESYNC = _sse_frame({"type": "resync"})
+
+class EventBroadcaster:
+    """Fans events out to bounded subscriber queues, optionally relayed through Redis pub/sub"""
+    
+    def __init__(self, queue_size, redis_url=None):
+        self.queue_size = queue_size
+        self.redis_url = redis_url
+        self.redis = None
+        self.relay = None
+        self.channels = {}
+        self.counters = {"published": 0, "delivered": 0, "resyncs": 0, "errors": 0}
+    
+    async def start(self):
+        if self.redis_url:
+            import redis.asyncio as redis
+            self.redis = redis.from_url(self.redis_url)
+            self.relay = asyncio.create_task(self._relay())
+    
+    async def close(self):
+        if self.relay is not None:
+            self.relay.cancel()
+            self.relay = None
+        if self.redis is not None:
+            await self.redis.aclose()
+            self.redis = None
+    
+    def subscribe(self, channel):
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        self.channels.setdefault(channel, set()).add(queue)
+        return queue
+    
+    def unsubscribe(self, channel, queue):
+        queues = self.channels.get(channel)
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self.channels[channel]
+    
+    def has_subscribers(self, channel):
+        return channel in self.channels
+    
+    async def publish(self, events):
+        """Publish (channel, event) pairs to every worker's subscribers"""
+        frames = [(channel, _sse_frame(event)) for channel, event in events]
+        self.counters["published"] += len(frames)
+        if self.redis is not None:
+            try:
+                async with self.redis.pipeline(transaction=False) as pipe:
+                    for channel, frame in frames:
+                        pipe.publish(f"events:{channel}", frame)
+                    await pipe.execute()
+                return
+            except Exception as e:
+                # Local subscribers still get the event when the backplane is down
+                self.counters["errors"] += 1
+                print(f"Error publishing events: {e}")
+        for channel, frame in frames:
+            self._fan_out(channel, frame)
+    
+    def publish_local(self, channel, event):
+        """Publish to this worker's subscribers only"""
+        self.counters["published"] += 1
+        self._fan_out(channel, _sse_frame(event))
+    
+    def _fan_out(self, channel, frame):
+        for queue in self.channels.get(channel, ()):
+            if queue.full():
+                # Dropping single events would leave the client's totals wrong, so replace
+                # the whole backlog with a resync marker
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(SSE_RESYNC)
+                self.counters["resyncs"] += 1
+                continue
+            queue.put_nowait(frame)
+            self.counters["delivered"] += 1
+    
+    async def _relay(self):
+        while True:
+            try:
+                pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+                await pubsub.psubscribe("events:*")
+                try:
+                    async for message in pubsub.listen():
+                        if message["type"] == "pmessage":
+                            self._fan_out(message["channel"].decode()[len("events:"):], message["data"])
+                finally:
+                    await pubsub.aclose()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self.counters["errors"] += 1
+                print(f"Error relaying events: {e}")
+                await asyncio.sleep(1)
+    
+    def stats(self):
+        return {
+            **self.counters,
+            "channels": len(self.channels),
+            "subscribers": sum(len(queues) for queues in self.channels.values()),
+            "backend": "redis" if self.redis is not None else "memory",
+            "queue_size": self.queue_size
+        }
+
+event_broadcaster = EventBroadcaster(EVENT_QUEUE_SIZE, EVENT_BACKPLANE_URL)
+
+async def publish_user_events(*events):
+    """Send events to the subscribers of each event's user"""
+    await event_broadcaster.publish([(f"user:{event['user_id']}", event) for event in events])
+
+async def _event_stream(channel, queue, first=None):
+    try:
+        if first is not None:
+            yield _sse_frame(first)
+        while True:
+            try:
+                frame = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                frame = SSE_KEEPALIVE
+            yield frame
+    finally:
+        event_broadcaster.unsubscribe(channel, queue)
+
+def _event_response(channel, queue, first=None):
+    return StreamingResponse(
+        _event_stream(channel, queue, first),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+async def publish_platform_ticker(interval=PLATFORM_TICKER_INTERVAL):
+    """Push platform stats to this worker's ticker subscribers; the stats come from the response cache"""
+    while True:
+        try:
+            if event_broadcaster.has_subscribers("platform"):
+                stats = await response_cache.get_or_load("platform", "stats", _compute_stats)
+                event_broadcaster.publish_local("platform", {"type": "platform.stats", "stats": stats})
+        except Exception as e:
+            print(f"Error publishing platform ticker: {e}")
+        await asyncio.sleep(interval)
 
 @app.get("/")
 async def root():
     return {"message": "USDT Staking API is running!"}
 
+@app.get("/healthz")
+async def healthz():
+    """Liveness: the process is up and its event loop is responsive"""
+    return {"status": "ok"}
+
+@app.get("/readyz")
+async def readyz():
+    """Readiness: MongoDB answers, required indexes exist and the reward scheduler is running"""
+    try:
+        await asyncio.wait_for(db.command("ping"), READINESS_PING_TIMEOUT)
+        mongo = True
+    except Exception:
+        mongo = False
+    checks = {
+        "mongo": mongo,
+        "indexes": startup_state["indexes_ready"],
+        "reward_scheduler": reward_scheduler.started
+    }
+    ready = all(checks.values())
+    return ORJSONResponse(
+        {"status": "ready" if ready else "starting", "checks": checks},
+        status_code=200 if ready else 503
+    )
+
 @app.post("/api/users")
 async def create_user(user: UserCreate):
     """Create a new user"""
     # Check if user already exists
-    existing_user = db.users.find_one({"email": user.email})
+    existing_user = await db.users.find_one({"email": user.email})
     if existing_user:
         raise HTTPException(status_code=400, detail="User already exists")
     
@@ -154,32 +2067,51 @@ async def create_user(user: UserCreate):
         "balance": 0.0,
         "staked_amount": 0.0,
         "total_rewards": 0.0,
-        "created_at": datetime.utcnow()
+        "created_at": datetime.utcnow(),
+        "stats": _empty_user_stats()
     }
     
-    db.users.insert_one(new_user)
+    try:
+        await db.users.insert_one(new_user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="User already exists")
+    await _inc_platform_totals(total_users=1)
+    await _inc_daily_rollups(new_user["created_at"], new_users=1)
+    await invalidate_cached_views()
     return {"message": "User created successfully", "user_id": new_user["id"]}
 
-@app.get("/api/users/{user_id}")
+@app.get("/api/users/{user_id}", response_model=UserResponse)
 async def get_user(user_id: str):
     """Get user information"""
-    user = db.users.find_one({"id": user_id})
+    user = await db.users.find_one({"id": user_id}, USER_RESPONSE_PROJECTION)
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    user["_id"] = str(user["_id"])
-    return user
+    now = datetime.utcnow()
+    active_stakes = await db.stakes.find(
+        {"user_id": user_id, "is_active": True},
+        REWARD_STAKE_PROJECTION
+    ).to_list(length=None)
+    user["accrued_rewards"] = sum(_accrued_reward(stake, now) for stake in active_stakes)
+    return ORJSONResponse(user)
+
+@app.get("/api/users/{user_id}/events")
+async def stream_user_events(user_id: str):
+    """Server-sent balance, stake, reward and deposit events for one user"""
+    # Subscribe before reading the snapshot so no event lands between the two
+    channel = f"user:{user_id}"
+    queue = event_broadcaster.subscribe(channel)
+    balances = await db.users.find_one({"id": user_id}, USER_BALANCE_PROJECTION)
+    if not balances:
+        event_broadcaster.unsubscribe(channel, queue)
+        raise HTTPException(status_code=404, detail="User not found")
+    return _event_response(channel, queue, {"type": "snapshot", "user_id": user_id, "balances": balances})
 
 @app.post("/api/payments/create")
 async def create_payment(payment: PaymentCreate):
     """Create a NOWPayments payment for USDT deposit"""
     try:
         # Create payment with NOWPayments
-        headers = {
-            "x-api-key": NOWPAYMENTS_API_KEY,
-            "Content-Type": "application/json"
-        }
-        
         payment_data = {
             "price_amount": payment.amount,
             "price_currency": "usd",
@@ -191,11 +2123,7 @@ async def create_payment(payment: PaymentCreate):
             "cancel_url": f"{os.environ.get('REACT_APP_BACKEND_URL', 'http://localhost:3000')}/dashboard?payment=cancelled"
         }
         
-        response = requests.post(
-            f"{NOWPAYMENTS_BASE_URL}/payment",
-            json=payment_data,
-            headers=headers
-        )
+        response = await payment_gateway.post("/payment", payment_data)
         
         if response.status_code != 200:
             # If NOWPayments fails, create a demo payment for testing
@@ -209,13 +2137,26 @@ async def create_payment(payment: PaymentCreate):
                 "created_at": datetime.utcnow(),
                 "payment_id": f"demo_{str(uuid.uuid4())[:8]}"
             }
-            db.transactions.insert_one(transaction)
+            await db.transactions.insert_one(transaction)
             
             # Auto-credit user balance for demo
-            db.users.update_one(
+            await db.users.update_one(
                 {"id": payment.user_id},
-                {"$inc": {"balance": payment.amount}}
+                {"$inc": {"balance": payment.amount, "stats.total_transactions": 1}}
+            )
+            await _inc_platform_totals(total_balance=payment.amount)
+            await _inc_daily_rollups(
+                transaction["created_at"], payment.user_id,
+                deposits=1, deposit_amount=payment.amount, transaction_count=1
             )
+            await invalidate_cached_views(payment.user_id)
+            await publish_user_events({
+                "type": "deposit.completed",
+                "user_id": payment.user_id,
+                "amount": payment.amount,
+                "changes": {"balance": payment.amount},
+                "at": transaction["created_at"]
+            })
             
             return {
                 "payment_url": f"{os.environ.get('REACT_APP_BACKEND_URL', 'http://localhost:3000')}/dashboard?payment=demo_success",
@@ -237,7 +2178,9 @@ async def create_payment(payment: PaymentCreate):
             "created_at": datetime.utcnow(),
             "payment_id": payment_response.get("payment_id")
         }
-        db.transactions.insert_one(transaction)
+        await db.transactions.insert_one(transaction)
+        await db.users.update_one({"id": payment.user_id}, {"$inc": {"stats.total_transactions": 1}})
+        await _inc_daily_rollups(transaction["created_at"], payment.user_id, transaction_count=1)
         
         return {
             "payment_url": payment_response.get("invoice_url"),
@@ -250,26 +2193,13 @@ async def create_payment(payment: PaymentCreate):
 
 @app.post("/api/payments/callback")
 async def payment_callback(callback_data: dict):
-    """Handle NOWPayments callback"""
+    """Handle NOWPayments callback by queueing it for the payment workers"""
     try:
         payment_id = callback_data.get("payment_id")
         payment_status = callback_data.get("payment_status")
         
-        if payment_status == "finished":
-            # Find the transaction
-            transaction = db.transactions.find_one({"payment_id": payment_id})
-            if transaction:
-                # Update user balance
-                db.users.update_one(
-                    {"id": transaction["user_id"]},
-                    {"$inc": {"balance": transaction["amount"]}}
-                )
-                
-                # Update transaction status
-                db.transactions.update_one(
-                    {"payment_id": payment_id},
-                    {"$set": {"status": "completed"}}
-                )
+        # Acknowledge immediately; duplicate deliveries collapse onto the same queue entry
+        await enqueue_payment_callback(payment_id, payment_status, callback_data)
         
         return {"status": "ok"}
         
@@ -277,185 +2207,650 @@ async def payment_callback(callback_data: dict):
         print(f"Error processing callback: {e}")
         return {"status": "error"}
 
+# Stake writes: "atomic" debits with one conditional update and batches the inserts behind it;
+# "transaction" runs the same writes in a multi-document transaction (requires a replica set)
+STAKE_WRITE_MODE = os.environ.get('STAKE_WRITE_MODE', 'atomic')
+
+@asynccontextmanager
+async def _stake_write_session():
+    """Yield a session inside a transaction in transaction mode, otherwise None"""
+    if STAKE_WRITE_MODE != "transaction":
+        yield None
+        return
+    async with await client.start_session() as session:
+        async with session.start_transaction():
+            yield session
+
+async def _write_together(session, *operations):
+    """Run independent writes concurrently, or one after another inside a transaction"""
+    if session is None:
+        return await asyncio.gather(*(operation(None) for operation in operations))
+    return [await operation(session) for operation in operations]
+
 @app.post("/api/stake")
 async def create_stake(stake: StakeCreate):
     """Create a new stake"""
-    # Check user balance
-    user = db.users.find_one({"id": stake.user_id})
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
+    if not stake.amount > 0:
+        raise HTTPException(status_code=400, detail="Stake amount must be positive")
     
-    if user["balance"] < stake.amount:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
+    now = datetime.utcnow()
+    if REWARD_MODE == "accrual":
+        # Settle first so rewards accrued so far can be restaked
+        await settle_user_rewards(stake.user_id, now)
     
-    # Create stake record
+    new_stake_id = str(uuid.uuid4())
     new_stake = {
-        "id": str(uuid.uuid4()),
+        "id": new_stake_id,
         "user_id": stake.user_id,
         "amount": stake.amount,
         "daily_rate": 0.30,  # 30% daily return
-        "start_date": datetime.utcnow(),
-        "last_reward_date": datetime.utcnow(),
+        "shard": _stake_shard(new_stake_id),
+        "start_date": now,
+        "last_reward_date": now,
         "is_active": True,
         "total_earned": 0.0
     }
-    
-    db.stakes.insert_one(new_stake)
-    
-    # Update user balance and staked amount
-    db.users.update_one(
-        {"id": stake.user_id},
-        {
-            "$inc": {
-                "balance": -stake.amount,
-                "staked_amount": stake.amount
-            }
-        }
-    )
-    
-    # Create transaction record
     transaction = {
         "id": str(uuid.uuid4()),
         "user_id": stake.user_id,
         "type": "stake",
         "amount": stake.amount,
         "status": "completed",
-        "created_at": datetime.utcnow()
+        "created_at": now
     }
-    db.transactions.insert_one(transaction)
+    
+    async with _stake_write_session() as session:
+        # The balance condition and the debit are one operation, so concurrent stakes cannot overdraw
+        debited = await db.users.find_one_and_update(
+            {"id": stake.user_id, "balance": {"$gte": stake.amount}},
+            {
+                "$inc": {
+                    "balance": -stake.amount,
+                    "staked_amount": stake.amount,
+                    "stats.active_stakes": 1,
+                    "stats.total_stakes": 1,
+                    "stats.total_invested": stake.amount,
+                    "stats.total_transactions": 1
+                },
+                "$max": {"stats.biggest_stake": stake.amount},
+                "$min": {"stats.first_stake_date": now}
+            },
+            projection=USER_BALANCE_PROJECTION,
+            return_document=ReturnDocument.AFTER,
+            session=session
+        )
+        if not debited:
+            if not await db.users.find_one({"id": stake.user_id}, {"_id": 1}, session=session):
+                raise HTTPException(status_code=404, detail="User not found")
+            raise HTTPException(status_code=400, detail="Insufficient balance")
+        
+        await _write_together(
+            session,
+            lambda s: db.stakes.insert_one(new_stake, session=s),
+            lambda s: db.transactions.insert_one(transaction, session=s)
+        )
+    
+    reward_scheduler.schedule(new_stake_id, new_stake["shard"], now + _reward_due_interval())
+    await asyncio.gather(
+        _inc_platform_totals(
+            total_balance=-stake.amount,
+            total_staked=stake.amount,
+            accrual_rate=stake.amount * 0.30,
+            accrual_weighted_since=stake.amount * 0.30 * _accrual_days(now)
+        ),
+        _inc_daily_rollups(
+            now, stake.user_id, new_stakes=1, staked_amount=stake.amount, transaction_count=1
+        ),
+        invalidate_cached_views(stake.user_id),
+        publish_user_events({
+            "type": "stake.created",
+            "user_id": stake.user_id,
+            "stake": {key: value for key, value in new_stake.items() if key != "_id"},
+            "balances": debited,
+            "at": now
+        })
+    )
     
     return {"message": "Stake created successfully", "stake_id": new_stake["id"]}
 
 @app.post("/api/unstake/{stake_id}")
 async def unstake(stake_id: str):
     """Unstake funds"""
-    # Find the stake
-    stake = db.stakes.find_one({"id": stake_id, "is_active": True})
-    if not stake:
-        raise HTTPException(status_code=404, detail="Active stake not found")
-    
-    # Calculate final reward if any time has passed
     now = datetime.utcnow()
-    last_reward = stake.get('last_reward_date', stake['start_date'])
-    
-    # If less than 24 hours, calculate partial reward
-    hours_since_reward = (now - last_reward).total_seconds() / 3600
-    if hours_since_reward > 0:
-        partial_reward = stake['amount'] * 0.30 * (hours_since_reward / 24)
-        
-        # Add partial reward
-        db.users.update_one(
-            {"id": stake["user_id"]},
-            {
-                "$inc": {
-                    "balance": partial_reward,
-                    "total_rewards": partial_reward
-                }
-            }
+    async with _stake_write_session() as session:
+        # Claiming the stake is the state change, so a concurrent unstake cannot pay it twice
+        stake = await db.stakes.find_one_and_update(
+            {"id": stake_id, "is_active": True},
+            {"$set": {"is_active": False, "end_date": now, "last_reward_date": now}},
+            session=session
         )
+        if not stake:
+            raise HTTPException(status_code=404, detail="Active stake not found")
         
-        db.stakes.update_one(
-            {"id": stake_id},
-            {"$inc": {"total_earned": partial_reward}}
-        )
-    
-    # Return staked amount to user balance
-    db.users.update_one(
-        {"id": stake["user_id"]},
-        {
-            "$inc": {
-                "balance": stake["amount"],
-                "staked_amount": -stake["amount"]
-            }
+        # Partial reward for the time since the last payout, credited with the principal
+        last_reward = _last_reward_date(stake)
+        partial_reward = _accrued_reward(stake, now) if now > last_reward else 0.0
+        transaction = {
+            "id": str(uuid.uuid4()),
+            "user_id": stake["user_id"],
+            "type": "unstake",
+            "amount": stake["amount"],
+            "status": "completed",
+            "created_at": now
         }
-    )
+        operations = [
+            lambda s: db.users.find_one_and_update(
+                {"id": stake["user_id"]},
+                {"$inc": {
+                    "balance": stake["amount"] + partial_reward,
+                    "staked_amount": -stake["amount"],
+                    "total_rewards": partial_reward,
+                    "stats.active_stakes": -1,
+                    "stats.completed_stakes": 1,
+                    "stats.total_transactions": 1
+                }},
+                projection=USER_BALANCE_PROJECTION,
+                return_document=ReturnDocument.AFTER,
+                session=s
+            ),
+            lambda s: db.transactions.insert_one(transaction, session=s)
+        ]
+        if partial_reward:
+            operations.append(lambda s: db.stakes.update_one(
+                {"id": stake_id},
+                {"$inc": {"total_earned": partial_reward}},
+                session=s
+            ))
+        balances = (await _write_together(session, *operations))[0]
     
-    # Mark stake as inactive
-    db.stakes.update_one(
-        {"id": stake_id},
-        {"$set": {"is_active": False, "end_date": now}}
+    reward_scheduler.cancel(stake_id)
+    if REWARD_MODE == "accrual":
+        await settle_user_rewards(stake["user_id"], now, exclude_stake_id=stake_id)
+    
+    rate = stake["amount"] * stake.get("daily_rate", 0.30)
+    await asyncio.gather(
+        _inc_platform_totals(
+            total_balance=stake["amount"] + partial_reward,
+            total_staked=-stake["amount"],
+            total_rewards=partial_reward,
+            accrual_rate=-rate,
+            accrual_weighted_since=-rate * _accrual_days(last_reward)
+        ),
+        _inc_daily_rollups(
+            now, stake["user_id"], unstakes=1, unstaked_amount=stake["amount"], transaction_count=1
+        ),
+        invalidate_cached_views(stake["user_id"]),
+        publish_user_events({
+            "type": "stake.closed",
+            "user_id": stake["user_id"],
+            "stake_id": stake_id,
+            "amount": stake["amount"],
+            "reward": partial_reward,
+            "balances": balances,
+            "at": now
+        })
     )
     
-    # Create transaction record
-    transaction = {
-        "id": str(uuid.uuid4()),
-        "user_id": stake["user_id"],
-        "type": "unstake",
-        "amount": stake["amount"],
-        "status": "completed",
-        "created_at": now
+    return {"message": "Unstaked successfully"}
+
+# Cold storage for old transactions: whole months past ARCHIVE_HORIZON_DAYS are moved to gzip
+# JSONL files under ARCHIVE_DIR/transactions/<YYYY-MM>/, one file per user-hash shard and run.
+# Each user's rows are a separate gzip member listed in a sidecar index, so a read maps the
+# file and decompresses only that user's slice
+ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'archive'))
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', '365'))
+ARCHIVE_SHARDS = int(os.environ.get('ARCHIVE_SHARDS', '16'))
+ARCHIVE_DELETE_BATCH_SIZE = int(os.environ.get('ARCHIVE_DELETE_BATCH_SIZE', '10000'))
+ARCHIVE_DATETIME_FIELDS = ("created_at", "completed_at", "period_start")
+
+def _archive_month_dir(month):
+    return os.path.join(ARCHIVE_DIR, "transactions", month)
+
+def _archive_shard(user_id):
+    return zlib.crc32(user_id.encode()) % ARCHIVE_SHARDS
+
+def _next_month(moment):
+    return (moment.replace(day=1) + timedelta(days=32)).replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+@functools.lru_cache(maxsize=256)
+def _load_archive_index(path):
+    # Segments are never rewritten, so their indexes can be cached for the process lifetime
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+def _parse_archived(line):
+    doc = orjson.loads(line)
+    for field in ARCHIVE_DATETIME_FIELDS:
+        if field in doc:
+            doc[field] = datetime.fromisoformat(doc[field])
+    return doc
+
+def _read_archived_month(month, user_id):
+    """Load one user's archived transactions for a month from every segment of their shard"""
+    directory = _archive_month_dir(month)
+    prefix = f"{_archive_shard(user_id):02d}-"
+    docs = {}
+    for name in sorted(os.listdir(directory)) if os.path.isdir(directory) else []:
+        if not (name.startswith(prefix) and name.endswith(".idx.json")):
+            continue
+        block = _load_archive_index(os.path.join(directory, name)).get(user_id)
+        if not block:
+            continue
+        offset, length = block[:2]
+        with open(os.path.join(directory, name[:-len(".idx.json")] + ".jsonl.gz"), "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                data = gzip.decompress(mapped[offset:offset + length])
+        for line in data.splitlines():
+            doc = _parse_archived(line)
+            # A rerun after an interrupted delete can archive a row twice
+            docs[doc["id"]] = doc
+    return list(docs.values())
+
+async def iter_archived_transactions(user_id, tx_type=None, start=None, end=None, position=None, floor=None):
+    """A user's archived transactions newest first, reading only the months the range reaches"""
+    summary = await db.archive_summaries.find_one({"_id": user_id}, {"months": 1})
+    if not summary:
+        return
+    lower = max([bound for bound in (start, floor) if bound], default=None)
+    upper = min([bound for bound in (end, position[0] if position else None) if bound], default=None)
+    
+    for month in sorted(summary["months"], reverse=True):
+        month_start = datetime.strptime(month, "%Y-%m")
+        if upper and month_start > upper:
+            continue
+        if lower and _next_month(month_start) <= lower:
+            break
+        docs = await asyncio.to_thread(_read_archived_month, month, user_id)
+        docs.sort(key=lambda doc: (doc["created_at"], doc["id"]), reverse=True)
+        for doc in docs:
+            if tx_type and doc["type"] != tx_type:
+                continue
+            if (start and doc["created_at"] < start) or (end and doc["created_at"] >= end):
+                continue
+            if position and (doc["created_at"], doc["id"]) >= position:
+                continue
+            yield doc
+
+def _archive_segment_key(directory, stem):
+    return f"{os.path.basename(directory)}/{stem}"
+
+async def _count_archive_segment(directory, stem, index):
+    """Add a segment's per-user totals to archive_summaries once, then mark it counted"""
+    key = _archive_segment_key(directory, stem)
+    operations = []
+    for user_id, block in index.items():
+        if len(block) < 7:
+            # Written before segments carried their totals, and counted when written
+            continue
+        _, _, count, reward_count, reward_amount, oldest, newest = block
+        operations.append(UpdateOne(
+            # Listing the segment on the summary makes a repeated count of it a no-op
+            {"_id": user_id, "segments": {"$ne": key}},
+            {
+                "$inc": {"count": count, "reward_count": reward_count, "reward_amount": reward_amount},
+                "$min": {"oldest": datetime.fromisoformat(oldest)},
+                "$max": {"archived_through": datetime.fromisoformat(newest)},
+                "$addToSet": {"months": os.path.basename(directory), "segments": key}
+            },
+            upsert=True
+        ))
+    if operations:
+        try:
+            await db.archive_summaries.bulk_write(operations, ordered=False)
+        except BulkWriteError as e:
+            # The upsert collides with a summary that already lists this segment
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+    with open(os.path.join(directory, stem + ".counted"), "wb"):
+        pass
+
+async def _archive_month(month_start):
+    """Write one month of settled transactions to a new segment per shard, then delete them"""
+    month = month_start.strftime("%Y-%m")
+    query = {
+        "created_at": {"$gte": month_start, "$lt": _next_month(month_start)},
+        "pending": {"$exists": False},
+        # Deposits still waiting for their gateway callback stay hot
+        "status": {"$nin": ["pending", "crediting"]}
     }
-    db.transactions.insert_one(transaction)
+    directory = _archive_month_dir(month)
+    os.makedirs(directory, exist_ok=True)
     
-    return {"message": "Unstaked successfully"}
+    # Count segments an interrupted run wrote but did not get to count
+    stems = [name[:-len(".idx.json")] for name in sorted(os.listdir(directory)) if name.endswith(".idx.json")]
+    for stem in stems:
+        if not os.path.exists(os.path.join(directory, stem + ".counted")):
+            index = _load_archive_index(os.path.join(directory, stem + ".idx.json"))
+            await _count_archive_segment(directory, stem, index)
+    
+    segment = f"{datetime.utcnow().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+    shards = {}
+    archived_ids = []
+    
+    def write_block(user_id, docs):
+        archived_ids.extend(doc["id"] for doc in docs)
+        if stems:
+            # Rows an interrupted run already archived are only deleted, not written again
+            archived = {doc["id"] for doc in _read_archived_month(month, user_id)}
+            docs = [doc for doc in docs if doc["id"] not in archived]
+            if not docs:
+                return
+        shard = _archive_shard(user_id)
+        if shard not in shards:
+            stem = f"{shard:02d}-{segment}"
+            shards[shard] = (stem, open(os.path.join(directory, stem + ".jsonl.gz.tmp"), "wb"), {})
+        stem, handle, index = shards[shard]
+        data = gzip.compress(b"".join(orjson.dumps(doc) + b"\n" for doc in docs))
+        rewards = [doc for doc in docs if doc["type"] == "reward"]
+        index[user_id] = [
+            handle.tell(), len(data), len(docs), len(rewards), sum(doc["amount"] for doc in rewards),
+            docs[-1]["created_at"].isoformat(), docs[0]["created_at"].isoformat()
+        ]
+        handle.write(data)
+    
+    current_user, block = None, []
+    cursor = db.transactions.find(query, {"_id": 0}).sort(
+        [("user_id", 1), ("created_at", -1), ("id", -1)]
+    ).allow_disk_use(True)
+    async for doc in cursor:
+        if doc["user_id"] != current_user and block:
+            write_block(current_user, block)
+            block = []
+        current_user = doc["user_id"]
+        block.append(doc)
+    if block:
+        write_block(current_user, block)
+    
+    # Data first, index next, counted last: readers only look at segments whose index
+    # exists, and a rerun counts any segment that has an index but is not marked counted
+    for stem, handle, index in shards.values():
+        handle.close()
+        path = os.path.join(directory, stem)
+        os.replace(path + ".jsonl.gz.tmp", path + ".jsonl.gz")
+        with open(path + ".idx.json.tmp", "wb") as f:
+            f.write(orjson.dumps(index))
+        os.replace(path + ".idx.json.tmp", path + ".idx.json")
+        await _count_archive_segment(directory, stem, index)
+    
+    # Delete exactly the rows read above, not whatever matches the query by now
+    deleted = 0
+    for i in range(0, len(archived_ids), ARCHIVE_DELETE_BATCH_SIZE):
+        result = await db.transactions.delete_many({"id": {"$in": archived_ids[i:i + ARCHIVE_DELETE_BATCH_SIZE]}})
+        deleted += result.deleted_count
+    return deleted
+
+async def archive_transactions(horizon_days=ARCHIVE_HORIZON_DAYS):
+    """Archive every whole month older than the horizon and return how many rows moved"""
+    cutoff = (datetime.utcnow() - timedelta(days=horizon_days)).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+    oldest = await db.transactions.find_one(
+        {"created_at": {"$lt": cutoff}}, {"created_at": 1}, sort=[("created_at", 1)]
+    )
+    archived = 0
+    month_start = oldest["created_at"].replace(day=1, hour=0, minute=0, second=0, microsecond=0) if oldest else cutoff
+    while month_start < cutoff:
+        moved = await _archive_month(month_start)
+        if moved:
+            print(f"Archived {moved} transactions from {month_start.strftime('%Y-%m')}")
+        archived += moved
+        month_start = _next_month(month_start)
+    return archived
+
+def _archived_rollup_increments():
+    """Per-user daily rollup deltas for everything in the archive, for the rollup backfill"""
+    increments = {}
+    root = os.path.join(ARCHIVE_DIR, "transactions")
+    for month in sorted(os.listdir(root)) if os.path.isdir(root) else []:
+        directory = os.path.join(root, month)
+        # A rerun after an interrupted delete can archive a row in two segments
+        seen = set()
+        for name in sorted(os.listdir(directory)):
+            if not name.endswith(".idx.json"):
+                continue
+            with open(os.path.join(directory, name[:-len(".idx.json")] + ".jsonl.gz"), "rb") as f:
+                lines = gzip.decompress(f.read()).splitlines()
+            for line in lines:
+                doc = _parse_archived(line)
+                if doc["id"] in seen:
+                    continue
+                seen.add(doc["id"])
+                deltas = {"transaction_count": 1}
+                if doc["type"] == "stake":
+                    deltas.update(new_stakes=1, staked_amount=doc["amount"])
+                elif doc["type"] == "unstake":
+                    deltas.update(unstakes=1, unstaked_amount=doc["amount"])
+                elif doc["type"] == "reward":
+                    deltas.update(reward_count=1, rewards_distributed=doc["amount"])
+                bucket = increments.setdefault((_rollup_day(doc["created_at"]), doc["user_id"]), {})
+                for field, value in deltas.items():
+                    bucket[field] = bucket.get(field, 0) + value
+                if doc["type"] == "deposit" and doc["status"] == "completed":
+                    credited = doc.get("completed_at", doc["created_at"])
+                    bucket = increments.setdefault((_rollup_day(credited), doc["user_id"]), {})
+                    bucket["deposits"] = bucket.get("deposits", 0) + 1
+                    bucket["deposit_amount"] = bucket.get("deposit_amount", 0) + doc["amount"]
+    return increments
+
+# Keyset pagination helpers for the per-user listings
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '1000'))
+
+def _json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+def _encode_cursor(sort_value, doc_id):
+    raw = json.dumps([sort_value.isoformat(), doc_id])
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def _decode_cursor(cursor):
+    try:
+        sort_value, doc_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(sort_value), doc_id
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+def _newest_first(docs, sort_field, limit):
+    return sorted(docs, key=lambda doc: (doc[sort_field], doc["id"]), reverse=True)[:limit]
+
+async def _paginate(collection, query, sort_field, limit, cursor, extra=None, projection=None):
+    """Return one newest-first page keyed on (sort_field, id) with the next cursor header.
+
+    extra(position, count, floor) loads up to count documents from other sources in the same
+    order, which are merged into the page. When the page is already full, nothing older than
+    floor can make it in, so those sources may skip it.
+    """
+    position = _decode_cursor(cursor) if cursor else None
+    if position:
+        sort_value, doc_id = position
+        query = {"$and": [query, {"$or": [
+            {sort_field: {"$lt": sort_value}},
+            {sort_field: sort_value, "id": {"$lt": doc_id}}
+        ]}]}
+    docs = await collection.find(query, projection or {"_id": 0}).sort(
+        [(sort_field, -1), ("id", -1)]
+    ).limit(limit + 1).to_list(length=None)
+    if extra is not None:
+        floor = docs[-1][sort_field] if len(docs) > limit else None
+        docs = _newest_first(docs + await extra(position, limit + 1, floor), sort_field, limit + 1)
+    headers = {}
+    if len(docs) > limit:
+        docs = docs[:limit]
+        headers["X-Next-Cursor"] = _encode_cursor(docs[-1][sort_field], docs[-1]["id"])
+    return ORJSONResponse(docs, headers=headers)
+
+async def _merge_newest_first(first, second, sort_field):
+    """Merge two newest-first document streams into one"""
+    def key(doc):
+        return (doc[sort_field], doc["id"])
+    
+    a = await anext(first, None)
+    b = await anext(second, None)
+    while a is not None or b is not None:
+        if b is None or (a is not None and key(a) >= key(b)):
+            yield a
+            a = await anext(first, None)
+        else:
+            yield b
+            b = await anext(second, None)
+
+def _stream_export(collection, query, sort_field, filename, extra=None, projection=None):
+    """Stream every matching document as a JSON array without buffering the result"""
+    async def generate():
+        docs = (
+            doc async for doc in collection.find(query, projection or {"_id": 0}).sort([(sort_field, -1), ("id", -1)])
+        )
+        if extra is not None:
+            docs = _merge_newest_first(docs, (doc async for doc in extra), sort_field)
+        yield b"["
+        first = True
+        async for doc in docs:
+            yield (b"" if first else b",") + orjson.dumps(doc)
+            first = False
+        yield b"]"
+    
+    return StreamingResponse(
+        generate(),
+        media_type="application/json",
+        headers={"Content-Disposition": f"attachment; filename={filename}"}
+    )
 
-@app.get("/api/users/{user_id}/stakes")
-async def get_user_stakes(user_id: str):
-    """Get all stakes for a user"""
-    stakes = list(db.stakes.find({"user_id": user_id}))
-    for stake in stakes:
-        stake["_id"] = str(stake["_id"])
-    return stakes
-
-@app.get("/api/users/{user_id}/transactions")
-async def get_user_transactions(user_id: str):
-    """Get all transactions for a user"""
-    transactions = list(db.transactions.find({"user_id": user_id}).sort("created_at", -1))
-    for transaction in transactions:
-        transaction["_id"] = str(transaction["_id"])
-    return transactions
+@app.get("/api/users/{user_id}/stakes", response_model=List[StakeResponse])
+async def get_user_stakes(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    export: bool = False
+):
+    """Get a page of stakes for a user, newest first"""
+    query = {"user_id": user_id}
+    if export:
+        return _stream_export(
+            db.stakes, query, "start_date", f"stakes-{user_id}.json", projection=STAKE_RESPONSE_PROJECTION
+        )
+    return await _paginate(db.stakes, query, "start_date", limit, cursor, projection=STAKE_RESPONSE_PROJECTION)
+
+@app.get("/api/users/{user_id}/transactions", response_model=List[TransactionResponse])
+async def get_user_transactions(
+    user_id: str,
+    limit: int = Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None,
+    tx_type: Optional[str] = Query(None, alias="type"),
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    export: bool = False
+):
+    """Get a page of transactions for a user, newest first"""
+    query = {"user_id": user_id}
+    if tx_type:
+        query["type"] = tx_type
+    if start or end:
+        query["created_at"] = {}
+        if start:
+            query["created_at"]["$gte"] = start
+        if end:
+            query["created_at"]["$lt"] = end
+    
+    # Rewards recorded in daily buckets and archived months are merged into the listing
+    with_buckets = tx_type in (None, "reward")
+    if export:
+        older = iter_archived_transactions(user_id, tx_type, start, end)
+        if with_buckets:
+            payouts = (doc async for doc in reward_bucket_payouts(user_id, start, end))
+            older = _merge_newest_first(payouts, older, "created_at")
+        return _stream_export(
+            db.transactions, query, "created_at", f"transactions-{user_id}.json", extra=older
+        )
+    
+    async def older(position, count, floor):
+        lower = max([bound for bound in (start, floor) if bound], default=None)
+        docs = []
+        async for doc in iter_archived_transactions(user_id, tx_type, start, end, position, floor):
+            docs.append(doc)
+            if len(docs) >= count:
+                break
+        if with_buckets:
+            docs += await reward_bucket_payouts(user_id, lower, end, position, count).to_list(length=None)
+        return docs
+    
+    return await _paginate(db.transactions, query, "created_at", limit, cursor, extra=older)
 
 @app.get("/api/users/{user_id}/analytics")
-async def get_user_analytics(user_id: str):
+async def get_user_analytics(user_id: str, days: int = Query(30, ge=1, le=365)):
     """Get comprehensive analytics for a user"""
-    user = db.users.find_one({"id": user_id})
+    return await response_cache.get_or_load(
+        f"user:{user_id}", f"analytics:{days}", lambda: _compute_user_analytics(user_id, days)
+    )
+
+async def _compute_user_analytics(user_id, days):
+    user = await db.users.find_one({"id": user_id})
     if not user:
         raise HTTPException(status_code=404, detail="User not found")
     
-    # Get all stakes
-    stakes = list(db.stakes.find({"user_id": user_id}))
+    # Only active stakes are needed; counts over all stakes come from the stats subdocument
+    stakes = await db.stakes.find(
+        {"user_id": user_id, "is_active": True},
+        {**REWARD_STAKE_PROJECTION, "is_active": 1}
+    ).to_list(length=None)
     
-    # Get all transactions
-    transactions = list(db.transactions.find({"user_id": user_id}).sort("created_at", 1))
+    return await _build_user_analytics(user, stakes, days)
+
+async def _build_user_analytics(user, stakes, days):
+    """Derive the analytics sections from an already loaded user and stake list"""
+    user_id = user["id"]
+    
+    # Counters come from the stats subdocument; users created before it existed get it
+    # computed in full on first read, replacing whatever the write paths $inc'ed meanwhile
+    stats = user.get("stats") or {}
+    if stats.get("version") != USER_STATS_VERSION:
+        stats = (await compute_user_stats([user_id]))[user_id]
+        await db.users.update_one(
+            {"id": user_id, "stats.version": {"$ne": USER_STATS_VERSION}},
+            {"$set": {"stats": stats}}
+        )
     
     # Calculate performance metrics
-    total_invested = sum([stake["amount"] for stake in stakes])
+    total_invested = stats["total_invested"]
     total_earned = user.get("total_rewards", 0)
     current_staked = user.get("staked_amount", 0)
     
     # Calculate ROI
     roi_percentage = (total_earned / total_invested * 100) if total_invested > 0 else 0
     
-    # Generate daily performance data (last 30 days)
+    # Generate daily performance data (last N days) from the user's daily rollups
+    current_date = datetime.utcnow() - timedelta(days=days)
+    reward_days = await get_daily_rollups(current_date, current_date + timedelta(days=days - 1), user_id)
+    
+    # Sweep the sorted active stake start dates once instead of rescanning per day
+    active_start_dates = sorted(s["start_date"].date() for s in stakes if s["is_active"])
+    started_index = 0
+    
     daily_data = []
-    current_date = datetime.utcnow() - timedelta(days=30)
     cumulative_earnings = 0
-    
-    for i in range(30):
+    for i in range(days):
         date = current_date + timedelta(days=i)
         date_str = date.strftime("%Y-%m-%d")
+        daily_rewards = reward_days.get(date_str, {}).get("rewards_distributed", 0)
         
-        # Calculate rewards for this day
-        daily_rewards = 0
-        for tx in transactions:
-            tx_date = tx["created_at"].strftime("%Y-%m-%d")
-            if tx_date == date_str and tx["type"] == "reward":
-                daily_rewards += tx["amount"]
+        while started_index < len(active_start_dates) and active_start_dates[started_index] <= date.date():
+            started_index += 1
         
         cumulative_earnings += daily_rewards
         daily_data.append({
             "date": date_str,
             "daily_rewards": daily_rewards,
             "cumulative_earnings": cumulative_earnings,
-            "active_stakes": len([s for s in stakes if s["is_active"] and s["start_date"].date() <= date.date()])
+            "active_stakes": started_index
         })
     
     # Portfolio breakdown
     portfolio_data = {
-        "active_stakes": len([s for s in stakes if s["is_active"]]),
-        "completed_stakes": len([s for s in stakes if not s["is_active"]]),
-        "total_stakes": len(stakes),
-        "average_stake_amount": total_invested / len(stakes) if stakes else 0
+        "active_stakes": stats["active_stakes"],
+        "completed_stakes": stats["completed_stakes"],
+        "total_stakes": stats["total_stakes"],
+        "average_stake_amount": total_invested / stats["total_stakes"] if stats["total_stakes"] else 0
     }
     
     # Projected earnings (next 30 days)
@@ -468,6 +2863,7 @@ async def get_user_analytics(user_id: str):
             "total_earned": total_earned,
             "current_staked": current_staked,
             "current_balance": user.get("balance", 0),
+            "accrued_rewards": sum(_accrued_reward(s, datetime.utcnow()) for s in stakes if s["is_active"]),
             "roi_percentage": roi_percentage,
             "days_active": (datetime.utcnow() - user["created_at"]).days if user.get("created_at") else 0
         },
@@ -484,75 +2880,89 @@ async def get_user_analytics(user_id: str):
             "yearly_projected": projected_daily * 365
         },
         "milestones": {
-            "first_stake_date": min([s["start_date"] for s in stakes]) if stakes else None,
-            "biggest_stake": max([s["amount"] for s in stakes]) if stakes else 0,
-            "total_transactions": len(transactions),
-            "reward_transactions": len([t for t in transactions if t["type"] == "reward"])
+            "first_stake_date": stats.get("first_stake_date"),
+            "biggest_stake": stats.get("biggest_stake", 0),
+            "total_transactions": stats["total_transactions"],
+            "reward_transactions": stats["reward_transactions"]
         }
     }
 
-@app.get("/api/analytics/platform")
-async def get_platform_analytics():
-    """Get platform-wide analytics"""
-    # Total stats
-    total_users = db.users.count_documents({})
-    
-    # Calculate total values using aggregation
-    total_staked_agg = list(db.users.aggregate([
-        {"$group": {"_id": None, "total": {"$sum": "$staked_amount"}}}
-    ]))
-    total_staked = total_staked_agg[0]["total"] if total_staked_agg else 0
+@app.get("/api/users/{user_id}/dashboard")
+async def get_user_dashboard(
+    user_id: str,
+    days: int = Query(30, ge=1, le=365),
+    transactions_limit: int = Query(20, ge=1, le=MAX_PAGE_SIZE)
+):
+    """Everything the dashboard renders, loaded once and shared between sections"""
+    user = await db.users.find_one({"id": user_id}, USER_RESPONSE_PROJECTION)
+    if not user:
+        raise HTTPException(status_code=404, detail="User not found")
     
-    total_rewards_agg = list(db.users.aggregate([
-        {"$group": {"_id": None, "total": {"$sum": "$total_rewards"}}}
-    ]))
-    total_rewards = total_rewards_agg[0]["total"] if total_rewards_agg else 0
+    stakes = await db.stakes.find({"user_id": user_id}, STAKE_RESPONSE_PROJECTION).sort(
+        [("start_date", -1), ("id", -1)]
+    ).to_list(length=None)
+    transactions = await db.transactions.find({"user_id": user_id}, {"_id": 0}).sort(
+        [("created_at", -1), ("id", -1)]
+    ).limit(transactions_limit).to_list(length=None)
+    payouts = await reward_bucket_payouts(user_id, limit=transactions_limit).to_list(length=None)
+    transactions = _newest_first(transactions + payouts, "created_at", transactions_limit)
     
-    total_balance_agg = list(db.users.aggregate([
-        {"$group": {"_id": None, "total": {"$sum": "$balance"}}}
-    ]))
-    total_balance = total_balance_agg[0]["total"] if total_balance_agg else 0
+    return ORJSONResponse({
+        "user": user,
+        "stakes": stakes,
+        "transactions": transactions,
+        "analytics": await _build_user_analytics(user, stakes, days),
+        "platform": await get_platform_analytics(days=30)
+    })
+
+@app.get("/api/analytics/platform")
+async def get_platform_analytics(days: int = Query(30, ge=1, le=365)):
+    """Get platform-wide analytics"""
+    return await response_cache.get_or_load(
+        "platform", f"analytics:{days}", lambda: _compute_platform_analytics(days)
+    )
+
+async def _compute_platform_analytics(days):
+    # Total stats from the incrementally maintained snapshot
+    totals = await get_platform_totals()
+    total_users = totals["total_users"]
+    total_staked = totals["total_staked"]
+    total_rewards = totals["total_rewards"]
+    total_balance = totals["total_balance"]
     
     # Active stakes
-    active_stakes = db.stakes.count_documents({"is_active": True})
-    total_stakes = db.stakes.count_documents({})
+    active_stakes = await db.stakes.count_documents({"is_active": True})
+    total_stakes = await db.stakes.count_documents({})
     
     # Recent activity (last 7 days)
     seven_days_ago = datetime.utcnow() - timedelta(days=7)
-    recent_users = db.users.count_documents({"created_at": {"$gte": seven_days_ago}})
-    recent_stakes = db.stakes.count_documents({"start_date": {"$gte": seven_days_ago}})
-    recent_transactions = db.transactions.count_documents({"created_at": {"$gte": seven_days_ago}})
+    recent_users = await db.users.count_documents({"created_at": {"$gte": seven_days_ago}})
+    recent_stakes = await db.stakes.count_documents({"start_date": {"$gte": seven_days_ago}})
+    recent_transactions = await db.transactions.count_documents({"created_at": {"$gte": seven_days_ago}})
+    recent_payouts = await db.reward_buckets.aggregate([
+        {"$match": {"day_start": {"$gte": seven_days_ago.replace(hour=0, minute=0, second=0, microsecond=0)}}},
+        {"$group": {"_id": None, "count": {"$sum": {"$size": {"$filter": {
+            "input": "$payouts",
+            "cond": {"$gte": ["$$this.created_at", seven_days_ago]}
+        }}}}}}
+    ]).to_list(length=None)
+    if recent_payouts:
+        recent_transactions += recent_payouts[0]["count"]
+    
+    # Daily stats for the requested window, a range read of the platform rollups
+    now = datetime.utcnow()
+    rollups = await get_daily_rollups(now - timedelta(days=days - 1), now)
     
-    # Daily stats for the last 30 days
     daily_stats = []
-    for i in range(30):
-        date = datetime.utcnow() - timedelta(days=29-i)
-        start_of_day = date.replace(hour=0, minute=0, second=0, microsecond=0)
-        end_of_day = start_of_day + timedelta(days=1)
-        
-        daily_rewards = 0
-        reward_transactions = list(db.transactions.find({
-            "type": "reward",
-            "created_at": {"$gte": start_of_day, "$lt": end_of_day}
-        }))
-        daily_rewards = sum([tx["amount"] for tx in reward_transactions])
-        
-        new_users = db.users.count_documents({
-            "created_at": {"$gte": start_of_day, "$lt": end_of_day}
-        })
-        
-        new_stakes = db.stakes.count_documents({
-            "start_date": {"$gte": start_of_day, "$lt": end_of_day}
-        })
-        
+    for i in range(days):
+        date_str = (now - timedelta(days=days - 1 - i)).strftime("%Y-%m-%d")
+        day = rollups.get(date_str, {})
         daily_stats.append({
-            "date": date.strftime("%Y-%m-%d"),
-            "new_users": new_users,
-            "new_stakes": new_stakes,
-            "rewards_distributed": daily_rewards,
-            "transaction_count": db.transactions.count_documents({
-                "created_at": {"$gte": start_of_day, "$lt": end_of_day}
-            })
+            "date": date_str,
+            "new_users": day.get("new_users", 0),
+            "new_stakes": day.get("new_stakes", 0),
+            "rewards_distributed": day.get("rewards_distributed", 0),
+            "transaction_count": day.get("transaction_count", 0)
         })
     
     return {
@@ -560,6 +2970,7 @@ async def get_platform_analytics():
             "total_users": total_users,
             "total_staked": total_staked,
             "total_rewards_distributed": total_rewards,
+            "accrued_rewards_unsettled": _platform_accrued(totals, datetime.utcnow()),
             "total_platform_value": total_staked + total_balance,
             "active_stakes": active_stakes,
             "completion_rate": ((total_stakes - active_stakes) / total_stakes * 100) if total_stakes > 0 else 0
@@ -580,22 +2991,127 @@ async def get_platform_analytics():
 @app.get("/api/stats")
 async def get_stats():
     """Get basic platform statistics (for backward compatibility)"""
-    total_users = db.users.count_documents({})
-    total_staked = db.users.aggregate([
-        {"$group": {"_id": None, "total": {"$sum": "$staked_amount"}}}
-    ])
-    total_staked = list(total_staked)
-    total_staked_amount = total_staked[0]["total"] if total_staked else 0
-    
-    total_rewards = db.users.aggregate([
-        {"$group": {"_id": None, "total": {"$sum": "$total_rewards"}}}
-    ])
-    total_rewards = list(total_rewards)
-    total_rewards_amount = total_rewards[0]["total"] if total_rewards else 0
+    return await response_cache.get_or_load("platform", "stats", _compute_stats)
+
+@app.get("/api/stats/events")
+async def stream_platform_stats():
+    """Server-sent platform stats ticker"""
+    queue = event_broadcaster.subscribe("platform")
+    stats = await response_cache.get_or_load("platform", "stats", _compute_stats)
+    return _event_response("platform", queue, {"type": "platform.stats", "stats": stats})
+
+async def _compute_stats():
+    totals = await get_platform_totals()
     
     return {
-        "total_users": total_users,
-        "total_staked": total_staked_amount,
-        "total_rewards_distributed": total_rewards_amount,
+        "total_users": totals["total_users"],
+        "total_staked": totals["total_staked"],
+        "total_rewards_distributed": totals["total_rewards"],
+        "accrued_rewards_unsettled": _platform_accrued(totals, datetime.utcnow()),
         "daily_apy": "30%"
     }
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+@app.get("/api/admin/cache")
+async def get_cache_stats():
+    """Report response cache hits, misses, coalesced loads, evictions and invalidations"""
+    return response_cache.stats()
+
+@app.delete("/api/admin/cache")
+async def invalidate_cache(user_id: Optional[str] = None):
+    """Drop the cached platform views and, if given, one user's"""
+    await invalidate_cached_views(*([user_id] if user_id else []))
+    return response_cache.stats()
+
+@app.get("/api/admin/events")
+async def get_event_stats():
+    """Report push channel subscribers, published and delivered events and resyncs"""
+    return event_broadcaster.stats()
+
+@app.get("/api/admin/payment-gateway")
+async def get_payment_gateway_stats():
+    """Report NOWPayments call counts and latency percentiles"""
+    return payment_gateway.stats()
+
+@app.get("/api/admin/payment-queue")
+async def get_payment_queue_stats():
+    """Report payment callback queue depth, lag and throughput"""
+    return await get_payment_queue_metrics()
+
+@app.get("/api/admin/reward-leases")
+async def get_reward_leases():
+    """Show which worker holds each reward shard"""
+    return {
+        "worker_id": REWARD_WORKER_ID,
+        "owned_shards": sorted(owned_reward_shards),
+        "leases": await db.reward_leases.find({}).sort("_id", 1).to_list(length=None),
+        "workers": await db.reward_workers.find({}).to_list(length=None)
+    }
+
+@app.get("/api/admin/reward-scheduler")
+async def get_reward_scheduler_stats():
+    """Report scheduled stakes, next payout, wakeup scan size and payout lateness"""
+    next_due = reward_scheduler._next_due()
+    return {
+        **reward_scheduler.stats,
+        "heap_size": len(reward_scheduler.due_at),
+        "next_due": next_due
+    }
+
+@app.get("/api/admin/reward-passes")
+async def get_reward_passes(limit: int = Query(20, ge=1, le=200)):
+    """Show running reward passes and the duration and throughput of recent ones"""
+    projection = {"stake_ids": 0}
+    running = await db.reward_passes.find({"status": "running"}, projection).to_list(length=None)
+    history = await db.reward_passes.find({"status": "completed"}, projection).sort(
+        "started_at", -1
+    ).limit(limit).to_list(length=None)
+    for record in history:
+        record["duration_seconds"] = (record["finished_at"] - record["started_at"]).total_seconds()
+    return {"running": running, "history": history}
+
+@app.get("/api/admin/query-plans")
+async def get_query_plans():
+    """Explain the query shapes used by the API and flag collection scans"""
+    report = await explain_query_shapes()
+    return {
+        "collscans": [entry["query"] for entry in report if entry["collscan"]],
+        "queries": report
+    }
+
+async def _run_command(command):
+    if command == "ensure-indexes":
+        created = await ensure_indexes()
+        print(f"{len(created)} indexes created")
+    elif command == "backfill-rollups":
+        count = await backfill_daily_rollups()
+        print(f"{count} daily rollups rebuilt")
+    elif command == "compact-rewards":
+        moved = await compact_reward_transactions()
+        print(f"{moved} reward transactions compacted into daily buckets")
+    elif command == "archive-transactions":
+        moved = await archive_transactions()
+        print(f"{moved} transactions archived to {ARCHIVE_DIR}")
+    elif command == "rebuild-user-stats":
+        count = await rebuild_user_stats()
+        print(f"stats rebuilt for {count} users")
+    elif command == "explain":
+        for entry in await explain_query_shapes():
+            flag = "COLLSCAN" if entry["collscan"] else "ok"
+            print(f"{flag:9} {entry['collection']:13} {entry['query']}: {' <- '.join(entry['stages'])}")
+
+if __name__ == "__main__":
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="USDT Staking API maintenance commands")
+    parser.add_argument("command", choices=["ensure-indexes", "explain", "backfill-rollups", "compact-rewards", "archive-transactions", "rebuild-user-stats"])
+    args = parser.parse_args()
+    asyncio.run(_run_command(args.command))
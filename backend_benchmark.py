@@ -0,0 +1,486 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from backend_test import USDTStakingAPITester
+
+ID_PATTERN = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+
+class LatencyRecorder:
+    """Thread-safe latency samples grouped by endpoint template"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+
+    def record(self, endpoint, latency, ok):
+        with self.lock:
+            self.samples.setdefault(endpoint, []).append(latency)
+            if not ok:
+                self.errors[endpoint] = self.errors.get(endpoint, 0) + 1
+
+    def report(self, elapsed):
+        endpoints = {}
+        total = 0
+        for endpoint, latencies in sorted(self.samples.items()):
+            latencies = sorted(latencies)
+            total += len(latencies)
+            endpoints[endpoint] = {
+                "requests": len(latencies),
+                "errors": self.errors.get(endpoint, 0),
+                "throughput_rps": len(latencies) / elapsed if elapsed > 0 else 0,
+                "mean_ms": sum(latencies) / len(latencies) * 1000,
+                "p50_ms": percentile(latencies, 0.50) * 1000,
+                "p95_ms": percentile(latencies, 0.95) * 1000,
+                "p99_ms": percentile(latencies, 0.99) * 1000,
+            }
+        return {
+            "elapsed_seconds": elapsed,
+            "total_requests": total,
+            "throughput_rps": total / elapsed if elapsed > 0 else 0,
+            "endpoints": endpoints,
+        }
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+class BenchmarkTester(USDTStakingAPITester):
+    """Virtual user that replays the API tester scenarios and records per-endpoint latency"""
+
+    def __init__(self, base_url, recorder):
+        super().__init__(base_url)
+        self.recorder = recorder
+        self.session = requests.Session()
+
+    def run_test(self, name, method, endpoint, expected_status, data=None):
+        """Run a single API call, timing it under its endpoint template"""
+        url = f"{self.base_url}{endpoint}"
+        template = f"{method} {ID_PATTERN.sub('{id}', endpoint)}"
+        self.tests_run += 1
+
+        started = time.perf_counter()
+        try:
+            if method == 'GET':
+                response = self.session.get(url)
+            else:
+                response = self.session.post(url, json=data)
+        except Exception:
+            self.recorder.record(template, time.perf_counter() - started, False)
+            return False, {}
+
+        success = response.status_code == expected_status
+        self.recorder.record(template, time.perf_counter() - started, success)
+        if success:
+            self.tests_passed += 1
+        try:
+            return success, response.json()
+        except ValueError:
+            return success, {}
+
+    def wait_for_balance(self, minimum, timeout=10):
+        """Poll the user until a gateway callback has credited the deposit"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            _, user_data = self.run_test("Poll Balance", "GET", f"/api/users/{self.user_id}", 200)
+            if user_data.get('balance', 0) >= minimum:
+                return True
+            time.sleep(0.2)
+        return False
+
+    def run_journey(self):
+        """One virtual user session: register, deposit, stake, browse, unstake"""
+        if not self.test_create_user():
+            return False
+        self.test_get_user()
+        self.test_create_payment()
+        if not self.wait_for_balance(50):
+            return False
+        self.test_create_stake()
+        self.test_get_user_stakes()
+        self.test_get_user_transactions()
+        self.test_user_analytics()
+        self.test_platform_analytics()
+        self.test_get_stats()
+        self.test_unstake()
+        return True
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    """Minimal NOWPayments stand-in that accepts payments and later posts a finished IPN"""
+
+    callback_delay = 0.2
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        payment_id = f"stub_{uuid.uuid4().hex[:12]}"
+        body = json.dumps({
+            "payment_id": payment_id,
+            "invoice_url": f"http://stub-gateway/invoice/{payment_id}",
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+        callback_url = payload.get("ipn_callback_url")
+        if callback_url:
+            threading.Timer(
+                self.callback_delay,
+                requests.post,
+                args=(callback_url,),
+                kwargs={"json": {"payment_id": payment_id, "payment_status": "finished"}, "timeout": 10},
+            ).start()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_stub_gateway(port):
+    server = ThreadingHTTPServer(("127.0.0.1", port), StubGatewayHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Stub gateway listening on http://127.0.0.1:{port}/v1 (start the API with NOWPAYMENTS_BASE_URL pointing here)")
+    return server
+
+
+def get_database(mongo_url):
+    from pymongo import MongoClient
+
+    return MongoClient(mongo_url).usdt_staking_db
+
+
+def seed_database(db, users, transactions, batch_size=10000):
+    """Bulk insert a realistic population of users, stakes and transaction history"""
+    now = datetime.utcnow()
+    user_ids = []
+    print(f"Seeding {users} users and {transactions} transactions...")
+
+    for offset in range(0, users, batch_size):
+        user_batch, stake_batch = [], []
+        for i in range(offset, min(offset + batch_size, users)):
+            user_id = str(uuid.uuid4())
+            user_ids.append(user_id)
+            staked = round(random.uniform(0, 5000), 2) if random.random() < 0.6 else 0.0
+            user_batch.append({
+                "id": user_id,
+                "email": f"seed{i}-{user_id[:8]}@example.com",
+                "name": f"Seed User {i}",
+                "balance": round(random.uniform(0, 1000), 2),
+                "staked_amount": staked,
+                "total_rewards": round(staked * random.uniform(0, 10), 2),
+                "created_at": now - timedelta(days=random.randint(0, 730)),
+            })
+            if staked:
+                start = now - timedelta(hours=random.randint(1, 24 * 365))
+                stake_batch.append({
+                    "id": str(uuid.uuid4()),
+                    "user_id": user_id,
+                    "amount": staked,
+                    "daily_rate": 0.30,
+                    "start_date": start,
+                    "last_reward_date": max(start, now - timedelta(hours=random.randint(0, 30))),
+                    "is_active": True,
+                    "total_earned": 0.0,
+                })
+        db.users.insert_many(user_batch, ordered=False)
+        if stake_batch:
+            db.stakes.insert_many(stake_batch, ordered=False)
+
+    types = ["reward"] * 8 + ["deposit", "stake"]
+    for offset in range(0, transactions, batch_size):
+        db.transactions.insert_many([
+            {
+                "id": str(uuid.uuid4()),
+                "user_id": random.choice(user_ids),
+                "type": random.choice(types),
+                "amount": round(random.uniform(1, 500), 2),
+                "status": "completed",
+                "created_at": now - timedelta(minutes=random.randint(0, 60 * 24 * 365)),
+            }
+            for _ in range(min(batch_size, transactions - offset))
+        ], ordered=False)
+    print("Seeding complete")
+
+
+def seed_history_user(db, history_length, batch_size=10000):
+    """Create one user with an hourly reward history of the given length.
+
+    The user's daily rollups and stats are seeded as the write paths would have maintained
+    them, so the analytics read the same documents as for a user who earned this history.
+    """
+    from pymongo import UpdateOne
+
+    now = datetime.utcnow()
+    user_id = str(uuid.uuid4())
+    db.users.insert_one({
+        "id": user_id,
+        "email": f"history-{user_id[:8]}@example.com",
+        "name": f"History {history_length}",
+        "balance": 0.0,
+        "staked_amount": 100.0,
+        "total_rewards": 30.0 * history_length,
+        "created_at": now - timedelta(hours=history_length),
+        "stats": {
+            "version": 1,
+            "active_stakes": 0,
+            "completed_stakes": 0,
+            "total_stakes": 0,
+            "total_invested": 0,
+            "total_transactions": history_length,
+            "reward_transactions": history_length,
+        },
+    })
+    daily = {}
+    for offset in range(0, history_length, batch_size):
+        batch = [
+            {
+                "id": str(uuid.uuid4()),
+                "user_id": user_id,
+                "type": "reward",
+                "amount": 30.0,
+                "status": "completed",
+                "created_at": now - timedelta(hours=i),
+            }
+            for i in range(offset, min(offset + batch_size, history_length))
+        ]
+        db.transactions.insert_many(batch, ordered=False)
+        for transaction in batch:
+            day = transaction["created_at"].strftime("%Y-%m-%d")
+            daily[day] = daily.get(day, 0) + 1
+
+    updates = []
+    for day, count in daily.items():
+        deltas = {"reward_count": count, "rewards_distributed": 30.0 * count, "transaction_count": count}
+        for rollup_id, rollup_user in ((f"platform:{day}", None), (f"user:{user_id}:{day}", user_id)):
+            updates.append(UpdateOne(
+                {"_id": rollup_id},
+                {"$inc": deltas, "$setOnInsert": {"date": day, "user_id": rollup_user}},
+                upsert=True,
+            ))
+    for offset in range(0, len(updates), batch_size):
+        db.daily_rollups.bulk_write(updates[offset:offset + batch_size], ordered=False)
+    return user_id
+
+
+def run_journey_scenario(args, recorder):
+    def virtual_user(_):
+        completed = 0
+        for _ in range(args.iterations):
+            if BenchmarkTester(args.base_url, recorder).run_journey():
+                completed += 1
+        return completed
+
+    # The reused test methods print progress; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        with ThreadPoolExecutor(max_workers=args.virtual_users) as pool:
+            completed = sum(pool.map(virtual_user, range(args.virtual_users)))
+    return {"journeys_completed": completed, "journeys_started": args.virtual_users * args.iterations}
+
+
+def run_history_scenario(args, recorder):
+    """Time user analytics for users whose history length differs by orders of magnitude"""
+    db = get_database(args.mongo_url)
+    results = {}
+    session = requests.Session()
+    for history_length in args.history_lengths:
+        user_id = seed_history_user(db, history_length)
+        endpoint = f"GET /api/users/{{id}}/analytics [history={history_length}]"
+        for _ in range(args.iterations):
+            # Drop the cached view first so every iteration times the analytics path itself
+            session.delete(f"{args.base_url}/api/admin/cache", params={"user_id": user_id})
+            started = time.perf_counter()
+            response = session.get(f"{args.base_url}/api/users/{user_id}/analytics")
+            recorder.record(endpoint, time.perf_counter() - started, response.status_code == 200)
+        results[str(history_length)] = percentile(sorted(recorder.samples[endpoint]), 0.50) * 1000
+    return {"analytics_p50_ms_by_history_length": results}
+
+
+def run_serialization_scenario(args, recorder):
+    """Time large listings over HTTP and compare the generic and orjson encoders in process"""
+    from fastapi.encoders import jsonable_encoder
+    import orjson
+
+    db = get_database(args.mongo_url)
+    user_id = seed_history_user(db, args.documents)
+    session = requests.Session()
+    listings = {
+        f"GET /api/users/{{id}}/transactions [export, {args.documents} docs]": "?export=true",
+        "GET /api/users/{id}/transactions [page of 1000]": "?limit=1000",
+    }
+    for _ in range(args.iterations):
+        for endpoint, query in listings.items():
+            started = time.perf_counter()
+            response = session.get(f"{args.base_url}/api/users/{user_id}/transactions{query}")
+            recorder.record(endpoint, time.perf_counter() - started, response.status_code == 200)
+
+    # The previous path loaded _id, stringified it per document and went through jsonable_encoder
+    with_ids = list(db.transactions.find({"user_id": user_id}))
+    projected = list(db.transactions.find({"user_id": user_id}, {"_id": 0}))
+
+    def generic():
+        for doc in with_ids:
+            doc["_id"] = str(doc["_id"])
+        return json.dumps(jsonable_encoder(with_ids)).encode()
+
+    def fast():
+        return orjson.dumps(projected)
+
+    timings = {}
+    for name, encode in (("jsonable_encoder", generic), ("orjson", fast)):
+        samples = []
+        for _ in range(args.iterations):
+            started = time.perf_counter()
+            encode()
+            samples.append(time.perf_counter() - started)
+        timings[f"{name}_p50_ms"] = percentile(sorted(samples), 0.50) * 1000
+    timings["speedup"] = timings["jsonable_encoder_p50_ms"] / timings["orjson_p50_ms"] if timings["orjson_p50_ms"] else 0
+    return {"documents": args.documents, **timings}
+
+
+def run_stake_burst_scenario(args, recorder):
+    """Fire concurrent stakes at one user per round and check the balance was never overdrawn"""
+    db = get_database(args.mongo_url)
+    endpoint = "POST /api/stake [burst]"
+    amount = 100.0
+    affordable = args.burst_size // 2
+    rounds = []
+    for _ in range(args.iterations):
+        user_id = str(uuid.uuid4())
+        db.users.insert_one({
+            "id": user_id,
+            "email": f"burst-{user_id[:8]}@example.com",
+            "name": "Stake Burst",
+            "balance": amount * affordable,
+            "staked_amount": 0.0,
+            "total_rewards": 0.0,
+            "created_at": datetime.utcnow(),
+        })
+
+        def stake(_):
+            started = time.perf_counter()
+            response = requests.post(f"{args.base_url}/api/stake", json={"user_id": user_id, "amount": amount})
+            # A rejected overdraft is the expected outcome for half the burst, not an error
+            recorder.record(endpoint, time.perf_counter() - started, response.status_code in (200, 400))
+            return response.status_code == 200
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.virtual_users) as pool:
+            accepted = sum(pool.map(stake, range(args.burst_size)))
+        elapsed = time.perf_counter() - started
+        user = db.users.find_one({"id": user_id})
+        rounds.append({
+            "accepted": accepted,
+            "stakes_per_second": args.burst_size / elapsed if elapsed > 0 else 0,
+            "final_balance": user["balance"],
+            "overdrawn": user["balance"] < 0 or accepted > affordable,
+        })
+
+    return {
+        "burst_size": args.burst_size,
+        "affordable_per_round": affordable,
+        "accepted_per_round": [r["accepted"] for r in rounds],
+        "stakes_per_second_mean": sum(r["stakes_per_second"] for r in rounds) / len(rounds) if rounds else 0,
+        "overdrawn_rounds": sum(r["overdrawn"] for r in rounds),
+    }
+
+
+SCENARIOS = {
+    "journey": run_journey_scenario,
+    "history": run_history_scenario,
+    "serialization": run_serialization_scenario,
+    "stake-burst": run_stake_burst_scenario,
+}
+
+
+def print_report(report):
+    print(f"\n📊 {report['total_requests']} requests in {report['elapsed_seconds']:.1f}s "
+          f"({report['throughput_rps']:.1f} req/s)")
+    print(f"{'endpoint':60} {'count':>7} {'err':>5} {'rps':>8} {'p50':>8} {'p95':>8} {'p99':>8}")
+    for endpoint, stats in report["endpoints"].items():
+        print(f"{endpoint:60} {stats['requests']:7d} {stats['errors']:5d} {stats['throughput_rps']:8.1f} "
+              f"{stats['p50_ms']:8.1f} {stats['p95_ms']:8.1f} {stats['p99_ms']:8.1f}")
+    for key, value in report.get("scenario", {}).items():
+        print(f"{key}: {value}")
+
+
+def print_comparison(report, baseline):
+    """Show p95 changes against a previous JSON report"""
+    print("\n📈 p95 compared with baseline")
+    for endpoint, stats in report["endpoints"].items():
+        previous = baseline.get("endpoints", {}).get(endpoint)
+        if not previous or not previous["p95_ms"]:
+            continue
+        change = (stats["p95_ms"] - previous["p95_ms"]) / previous["p95_ms"] * 100
+        print(f"{endpoint:60} {previous['p95_ms']:8.1f} -> {stats['p95_ms']:8.1f} ms ({change:+.1f}%)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the USDT Staking API")
+    parser.add_argument("--base-url", default=os.environ.get("BENCHMARK_BASE_URL", "http://localhost:8001"))
+    parser.add_argument("--mongo-url", default=os.environ.get("MONGO_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--scenario", choices=sorted(SCENARIOS), default="journey")
+    parser.add_argument("--virtual-users", type=int, default=20)
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--seed-users", type=int, default=0)
+    parser.add_argument("--seed-transactions", type=int, default=0)
+    parser.add_argument("--history-lengths", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument("--documents", type=int, default=10000, help="listing size for the serialization scenario")
+    parser.add_argument("--burst-size", type=int, default=50, help="concurrent stakes per round in stake-burst")
+    parser.add_argument("--stub-gateway-port", type=int, default=0)
+    parser.add_argument("--json", metavar="PATH", help="write the report as JSON ('-' for stdout)")
+    parser.add_argument("--compare", metavar="PATH", help="baseline JSON report to compare against")
+    args = parser.parse_args()
+
+    if args.seed_users or args.seed_transactions:
+        seed_database(get_database(args.mongo_url), max(args.seed_users, 1), args.seed_transactions)
+    if args.stub_gateway_port:
+        start_stub_gateway(args.stub_gateway_port)
+
+    recorder = LatencyRecorder()
+    started = time.perf_counter()
+    scenario_result = SCENARIOS[args.scenario](args, recorder)
+    report = recorder.report(time.perf_counter() - started)
+    report["scenario"] = scenario_result
+    report["config"] = {
+        "scenario": args.scenario,
+        "virtual_users": args.virtual_users,
+        "iterations": args.iterations,
+    }
+
+    if args.json == "-":
+        json.dump(report, sys.stdout, indent=2)
+    else:
+        print_report(report)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(report, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(report, json.load(f))
+
+    errors = sum(stats["errors"] for stats in report["endpoints"].values())
+    return 0 if errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
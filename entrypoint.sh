@@ -6,16 +6,27 @@ cd /backend || { echo "Backend directory not found"; exit 1; }
 
 echo "Starting FastAPI backend"
 # Start Uvicorn with proper host binding
-uvicorn server:app --host 0.0.0.0 --port 8001 &
+uvicorn server:app --host 0.0.0.0 --port 8001 --workers "${UVICORN_WORKERS:-1}" &
 BACKEND_PID=$!
 
-echo "Waiting for backend to start..."
-sleep 30
-
-if ! kill -0 $BACKEND_PID 2>/dev/null; then
-    echo "Backend failed to start at initialization, exiting"
-    exit 1
-fi
+# Poll readiness instead of sleeping a fixed time, so nginx starts as soon as the API can serve
+echo "Waiting for backend to become ready..."
+READY_TIMEOUT="${BACKEND_READY_TIMEOUT:-120}"
+WAITED=0
+until wget -q -O /dev/null http://127.0.0.1:8001/readyz 2>/dev/null; do
+    if ! kill -0 $BACKEND_PID 2>/dev/null; then
+        echo "Backend failed to start at initialization, exiting"
+        exit 1
+    fi
+    if [ "$WAITED" -ge "$READY_TIMEOUT" ]; then
+        echo "Backend not ready after ${READY_TIMEOUT}s, exiting"
+        kill $BACKEND_PID
+        exit 1
+    fi
+    sleep 1
+    WAITED=$((WAITED + 1))
+done
+echo "Backend ready after ${WAITED}s"
 
 # Start Nginx
 nginx -g 'daemon off;' &
@@ -46,51 +46,72 @@ function App() {
 
   useEffect(() => {
     if (currentUser) {
-      fetchUserData();
-      fetchUserStakes();
-      fetchUserTransactions();
-      fetchUserAnalytics();
+      fetchDashboard();
+    } else {
+      fetchPlatformAnalytics();
     }
-    fetchPlatformAnalytics();
   }, [currentUser]);
 
-  const fetchUserData = async () => {
-    try {
-      const response = await fetch(`${API_BASE_URL}/api/users/${currentUser}`);
-      const data = await response.json();
-      setUserData(data);
-    } catch (error) {
-      console.error('Error fetching user data:', error);
-    }
-  };
-
-  const fetchUserStakes = async () => {
-    try {
-      const response = await fetch(`${API_BASE_URL}/api/users/${currentUser}/stakes`);
-      const data = await response.json();
-      setStakes(data);
-    } catch (error) {
-      console.error('Error fetching stakes:', error);
-    }
-  };
+  // Balance, stake and reward changes are pushed by the backend instead of re-polled
+  useEffect(() => {
+    if (!currentUser) return undefined;
+    const source = new EventSource(`${API_BASE_URL}/api/users/${currentUser}/events`);
+    source.onmessage = (message) => {
+      const event = JSON.parse(message.data);
+      if (event.type === 'resync') {
+        fetchDashboard();
+        return;
+      }
+      if (event.balances) {
+        setUserData((prev) => (prev ? { ...prev, ...event.balances } : prev));
+      } else if (event.changes) {
+        setUserData((prev) => {
+          if (!prev) return prev;
+          const next = { ...prev };
+          Object.entries(event.changes).forEach(([field, delta]) => {
+            next[field] = (next[field] || 0) + delta;
+          });
+          return next;
+        });
+      }
+      if (event.type === 'stake.created') {
+        setStakes((prev) => (prev.some((s) => s.id === event.stake.id) ? prev : [event.stake, ...prev]));
+      } else if (event.type === 'stake.closed') {
+        setStakes((prev) => prev.map((s) => (s.id === event.stake_id ? { ...s, is_active: false, end_date: event.at } : s)));
+      }
+    };
+    return () => source.close();
+  }, [currentUser]);
 
-  const fetchUserTransactions = async () => {
-    try {
-      const response = await fetch(`${API_BASE_URL}/api/users/${currentUser}/transactions`);
-      const data = await response.json();
-      setTransactions(data);
-    } catch (error) {
-      console.error('Error fetching transactions:', error);
-    }
-  };
+  useEffect(() => {
+    const source = new EventSource(`${API_BASE_URL}/api/stats/events`);
+    source.onmessage = (message) => {
+      const event = JSON.parse(message.data);
+      if (event.type !== 'platform.stats') return;
+      setPlatformAnalytics((prev) => ({
+        ...prev,
+        overview: {
+          ...prev?.overview,
+          total_users: event.stats.total_users,
+          total_staked: event.stats.total_staked,
+          total_rewards_distributed: event.stats.total_rewards_distributed
+        }
+      }));
+    };
+    return () => source.close();
+  }, []);
 
-  const fetchUserAnalytics = async () => {
+  const fetchDashboard = async () => {
     try {
-      const response = await fetch(`${API_BASE_URL}/api/users/${currentUser}/analytics`);
+      const response = await fetch(`${API_BASE_URL}/api/users/${currentUser}/dashboard`);
       const data = await response.json();
-      setAnalytics(data);
+      setUserData(data.user);
+      setStakes(data.stakes);
+      setTransactions(data.transactions);
+      setAnalytics(data.analytics);
+      setPlatformAnalytics(data.platform);
     } catch (error) {
-      console.error('Error fetching analytics:', error);
+      console.error('Error fetching dashboard:', error);
     }
   };
 
@@ -165,9 +186,7 @@ function App() {
         if (data.demo_mode) {
           alert('Demo Mode: Your balance has been credited automatically! You can now stake USDT.');
           setDepositAmount('');
-          fetchUserData();
-          fetchUserTransactions();
-          fetchUserAnalytics();
+          fetchDashboard();
         } else {
           window.open(data.payment_url, '_blank');
           setDepositAmount('');
@@ -201,10 +220,7 @@ function App() {
       if (response.ok) {
         alert('Staked successfully!');
         setStakeAmount('');
-        fetchUserData();
-        fetchUserStakes();
-        fetchUserTransactions();
-        fetchUserAnalytics();
+        fetchDashboard();
       } else {
         alert(data.detail);
       }
@@ -223,10 +239,7 @@ function App() {
       const data = await response.json();
       if (response.ok) {
         alert('Unstaked successfully!');
-        fetchUserData();
-        fetchUserStakes();
-        fetchUserTransactions();
-        fetchUserAnalytics();
+        fetchDashboard();
       } else {
         alert(data.detail);
       }
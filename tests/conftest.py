@@ -0,0 +1,28 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+try:
+    import mongomock_motor
+except ImportError:
+    # The backend tests run against an in-memory Mongo; without it there is nothing to run
+    mongomock_motor = None
+    collect_ignore_glob = ["test_*.py"]
+
+
+class SimulatedCrash(Exception):
+    """Raised by a patched step to stop a write path part way through"""
+
+
+@pytest.fixture
+def db(monkeypatch):
+    """A fresh in-memory database installed as server.db, with the transactions reward ledger"""
+    import server
+
+    database = mongomock_motor.AsyncMongoMockClient()["usdt_staking_test"]
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(server, "REWARD_LEDGER", "transactions")
+    return database
@@ -0,0 +1,84 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from tests.conftest import SimulatedCrash
+
+
+MONTH_START = datetime(2020, 3, 1)
+
+
+@pytest.fixture
+def db(db, monkeypatch, tmp_path):
+    database = db
+    monkeypatch.setattr(server, "ARCHIVE_DIR", str(tmp_path))
+
+    async def seed():
+        await database.transactions.insert_many([
+            {
+                "id": f"tx-{i}", "user_id": f"user-{i % 3}", "type": "reward" if i % 2 else "deposit",
+                "amount": 10.0, "status": "completed", "created_at": MONTH_START + timedelta(hours=i)
+            }
+            for i in range(12)
+        ])
+
+    asyncio.run(seed())
+    return database
+
+
+def summaries(db):
+    async def load():
+        return {summary["_id"]: summary async for summary in db.archive_summaries.find()}
+
+    return asyncio.run(load())
+
+
+def archive():
+    return asyncio.run(server._archive_month(MONTH_START))
+
+
+def assert_archived_once(db):
+    found = summaries(db)
+    assert {user_id: summary["count"] for user_id, summary in found.items()} == {
+        "user-0": 4, "user-1": 4, "user-2": 4
+    }
+    assert sum(summary["reward_count"] for summary in found.values()) == 6
+    assert sum(summary["reward_amount"] for summary in found.values()) == 60.0
+    assert asyncio.run(db.transactions.count_documents({})) == 0
+    for user_id in found:
+        assert len(server._read_archived_month("2020-03", user_id)) == 4
+
+    rollups = server._archived_rollup_increments()
+    assert sum(deltas["transaction_count"] for deltas in rollups.values()) == 12
+
+
+def test_rerun_after_crash_before_delete_counts_once(db):
+    async def snapshot():
+        return await db.transactions.find({}, {"_id": 0}).to_list(length=None)
+
+    rows = asyncio.run(snapshot())
+    assert archive() == 12
+    # State left by a run that died after counting its segments but before deleting
+    asyncio.run(db.transactions.insert_many(rows))
+
+    assert archive() == 12
+    assert_archived_once(db)
+
+
+def test_rerun_after_crash_before_count_counts_once(db, monkeypatch):
+    count_segment = server._count_archive_segment
+
+    async def crash(*args, **kwargs):
+        raise SimulatedCrash()
+
+    monkeypatch.setattr(server, "_count_archive_segment", crash)
+    with pytest.raises(SimulatedCrash):
+        archive()
+    monkeypatch.setattr(server, "_count_archive_segment", count_segment)
+
+    assert archive() == 12
+    assert_archived_once(db)
+    assert archive() == 0
+    assert_archived_once(db)
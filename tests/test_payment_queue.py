@@ -0,0 +1,90 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+from tests.conftest import SimulatedCrash
+
+
+@pytest.fixture
+def db(db):
+    database = db
+
+    async def seed():
+        await database.users.insert_one({"id": "user", "balance": 0.0})
+        await database.transactions.insert_one({
+            "id": "deposit", "user_id": "user", "type": "deposit", "amount": 25.0,
+            "status": "pending", "payment_id": "payment", "created_at": datetime.utcnow()
+        })
+
+    asyncio.run(seed())
+    return database
+
+
+def job():
+    return {"_id": "payment:finished", "payment_id": "payment", "payment_status": "finished"}
+
+
+def state(db):
+    async def load():
+        user = await db.users.find_one({"id": "user"})
+        transaction = await db.transactions.find_one({"id": "deposit"})
+        return user, transaction
+
+    return asyncio.run(load())
+
+
+def test_retry_after_crash_between_credit_and_completion_credits_once(db, monkeypatch):
+    inc_platform_totals = server._inc_platform_totals
+
+    async def crash(**deltas):
+        raise SimulatedCrash()
+
+    monkeypatch.setattr(server, "_inc_platform_totals", crash)
+    with pytest.raises(SimulatedCrash):
+        asyncio.run(server._process_payment_callbacks([job()]))
+    monkeypatch.setattr(server, "_inc_platform_totals", inc_platform_totals)
+
+    user, transaction = state(db)
+    assert user["balance"] == 25.0
+    assert transaction["status"] == "crediting"
+
+    asyncio.run(server._process_payment_callbacks([job()]))
+    asyncio.run(server._process_payment_callbacks([job()]))
+    user, transaction = state(db)
+    assert user["balance"] == 25.0
+    assert user["deposit_credits"] == []
+    assert transaction["status"] == "completed"
+
+
+def test_retry_after_crash_before_credit_still_credits(db):
+    # State left by a worker that died right after moving the deposit to crediting
+    asyncio.run(db.transactions.update_one({"id": "deposit"}, {"$set": {"status": "crediting"}}))
+
+    asyncio.run(server._process_payment_callbacks([job()]))
+    user, transaction = state(db)
+    assert user["balance"] == 25.0
+    assert transaction["status"] == "completed"
+
+
+def test_retried_deposit_does_not_block_a_new_one_for_the_same_user(db):
+    async def seed():
+        # Deposit A was credited by a job that died before completing it; B is new
+        await db.users.update_one({"id": "user"}, {"$set": {"balance": 10.0, "deposit_credits": ["deposit"]}})
+        await db.transactions.update_one({"id": "deposit"}, {"$set": {"status": "crediting"}})
+        await db.transactions.insert_one({
+            "id": "second", "user_id": "user", "type": "deposit", "amount": 50.0,
+            "status": "pending", "payment_id": "second-payment", "created_at": datetime.utcnow()
+        })
+
+    asyncio.run(seed())
+    second_job = {"_id": "second-payment:finished", "payment_id": "second-payment", "payment_status": "finished"}
+    asyncio.run(server._process_payment_callbacks([job(), second_job]))
+
+    user, transaction = state(db)
+    second = asyncio.run(db.transactions.find_one({"id": "second"}))
+    assert user["balance"] == 60.0
+    assert user["deposit_credits"] == []
+    assert transaction["status"] == "completed"
+    assert second["status"] == "completed"
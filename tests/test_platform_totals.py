@@ -0,0 +1,72 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import server
+
+
+@pytest.fixture
+def db(db):
+    database = db
+
+    async def seed():
+        await database.users.insert_one({"id": "user", "balance": 10.0, "total_rewards": 0.0})
+        # The snapshot has drifted 5.0 above the user balances
+        await database.platform_stats.insert_one({
+            "_id": server.PLATFORM_TOTALS_ID, "total_users": 1, "total_balance": 15.0, "updated_at": datetime.utcnow()
+        })
+
+    asyncio.run(seed())
+    return database
+
+
+def snapshot(db):
+    return asyncio.run(db.platform_stats.find_one({"_id": server.PLATFORM_TOTALS_ID}))
+
+
+def test_reconcile_corrects_only_persistent_drift_and_keeps_increments(db):
+    drift, corrected = asyncio.run(server.reconcile_platform_totals())
+    assert drift["total_balance"] == -5.0
+    assert corrected == {}
+    assert snapshot(db)["total_balance"] == 15.0
+
+    # A deposit credited after the scan: the snapshot moves with it and the drift stays the same
+    async def deposit():
+        await db.users.update_one({"id": "user"}, {"$inc": {"balance": 20.0}})
+        await server._inc_platform_totals(total_balance=20.0)
+
+    asyncio.run(deposit())
+    drift, corrected = asyncio.run(server.reconcile_platform_totals())
+    assert corrected == {"total_balance": -5.0}
+    assert snapshot(db)["total_balance"] == 30.0
+
+    drift, corrected = asyncio.run(server.reconcile_platform_totals())
+    assert drift["total_balance"] == 0.0
+    assert corrected == {}
+    assert snapshot(db)["total_balance"] == 30.0
+
+
+def test_transient_drift_is_reported_but_not_corrected(db):
+    async def run():
+        await db.platform_stats.update_one({"_id": server.PLATFORM_TOTALS_ID}, {"$set": {"total_balance": 10.0}})
+        first = await server.reconcile_platform_totals()
+        # An increment seen by the snapshot read but not by the scan
+        await server._inc_platform_totals(total_balance=3.0)
+        second = await server.reconcile_platform_totals()
+        await db.users.update_one({"id": "user"}, {"$inc": {"balance": 3.0}})
+        third = await server.reconcile_platform_totals()
+        return first, second, third
+
+    first, second, third = asyncio.run(run())
+    assert first[0]["total_balance"] == 0.0 and first[1] == {}
+    assert second[0]["total_balance"] == -3.0 and second[1] == {}
+    assert third[0]["total_balance"] == 0.0 and third[1] == {}
+    assert snapshot(db)["total_balance"] == 13.0
+
+
+def test_one_worker_claims_each_reconcile_slot(db):
+    async def run():
+        return [await server._claim_platform_totals_reconcile() for _ in range(3)]
+
+    assert asyncio.run(run()) == [True, False, False]
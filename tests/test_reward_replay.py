@@ -0,0 +1,152 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import pytest
+
+import server
+from tests.conftest import SimulatedCrash
+
+
+def seed(db, stakes=2):
+    """One user with a few stakes that are exactly one day unpaid"""
+    start = (datetime.utcnow() - timedelta(days=1)).replace(microsecond=0)
+
+    async def insert():
+        await db.users.insert_one({"id": "user", "balance": 0.0, "total_rewards": 0.0})
+        await db.stakes.insert_many([
+            {
+                "id": f"stake-{i}", "user_id": "user", "amount": 100.0, "daily_rate": 0.30,
+                "start_date": start, "last_reward_date": start, "is_active": True, "shard": 0
+            }
+            for i in range(stakes)
+        ])
+
+    asyncio.run(insert())
+
+
+def pay(db, pass_id, now):
+    """Record and apply one batch for every active stake, like a reward pass"""
+    async def run():
+        batch = await db.stakes.find({"is_active": True}, server.REWARD_STAKE_PROJECTION).to_list(length=None)
+        return await server._flush_reward_batch(batch, now, pass_id)
+
+    return asyncio.run(run())
+
+
+def recover(pass_id):
+    return asyncio.run(server._recover_pending_rewards({"pass_id": pass_id}))
+
+
+def state(db):
+    async def load():
+        user = await db.users.find_one({"id": "user"})
+        totals = await db.platform_stats.find_one({"_id": server.PLATFORM_TOTALS_ID}) or {}
+        pending = await db.transactions.count_documents({"pending": {"$exists": True}})
+        rewards = await db.transactions.count_documents({"type": "reward"})
+        return user, totals, pending, rewards
+
+    return asyncio.run(load())
+
+
+def test_replay_after_crash_before_clear_credits_once(db, monkeypatch):
+    seed(db)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    clear = server._clear_pending_rewards
+
+    async def crash(entries):
+        raise SimulatedCrash()
+
+    monkeypatch.setattr(server, "_clear_pending_rewards", crash)
+    with pytest.raises(SimulatedCrash):
+        pay(db, "pass-1", now)
+    monkeypatch.setattr(server, "_clear_pending_rewards", clear)
+
+    assert recover("pass-1") == (0.0, 0)
+    user, totals, pending, rewards = state(db)
+    assert user["balance"] == pytest.approx(60.0)
+    assert user["total_rewards"] == pytest.approx(60.0)
+    assert user["reward_credits"] == []
+    assert totals["total_rewards"] == pytest.approx(60.0)
+    assert pending == 0
+    assert rewards == 2
+
+
+def test_replay_after_crash_before_user_credit_credits_once(db, monkeypatch):
+    seed(db)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    credit = server._credit_reward_users
+
+    async def crash(entries):
+        raise SimulatedCrash()
+
+    monkeypatch.setattr(server, "_credit_reward_users", crash)
+    with pytest.raises(SimulatedCrash):
+        pay(db, "pass-1", now)
+    monkeypatch.setattr(server, "_credit_reward_users", credit)
+
+    assert recover("pass-1") == pytest.approx((60.0, 2))
+    assert recover("pass-1") == (0.0, 0)
+    user, totals, pending, rewards = state(db)
+    assert user["balance"] == pytest.approx(60.0)
+    assert totals["total_rewards"] == pytest.approx(60.0)
+    assert pending == 0
+    assert rewards == 2
+
+
+def test_concurrent_settles_of_one_period_pay_once(db):
+    seed(db, stakes=1)
+    now = datetime.utcnow().replace(microsecond=0)
+
+    async def race():
+        stake = await db.stakes.find_one({"id": "stake-0"}, server.REWARD_STAKE_PROJECTION)
+        return await asyncio.gather(*(
+            server._flush_reward_batch([dict(stake)], now, f"settle-{i}", prorate=True)
+            for i in range(3)
+        ))
+
+    paid = asyncio.run(race())
+    user, totals, pending, rewards = state(db)
+    assert sorted(paid) == [(0.0, 0), (0.0, 0), (pytest.approx(30.0), 1)]
+    assert user["balance"] == pytest.approx(30.0)
+    assert totals["total_rewards"] == pytest.approx(30.0)
+    assert pending == 0
+    assert rewards == 1
+
+
+def test_scheduler_tick_settles_a_pass_interrupted_in_steady_state(db, monkeypatch):
+    seed(db)
+    now = datetime.utcnow().replace(microsecond=0)
+    monkeypatch.setattr(server, "owned_reward_shards", {0})
+    scheduler = server.RewardScheduler()
+    scheduler.shards = {0}
+    scheduler.synced_at = now
+
+    credit = server._credit_reward_users
+
+    async def crash_once(entries):
+        monkeypatch.setattr(server, "_credit_reward_users", credit)
+        raise SimulatedCrash()
+
+    async def run():
+        monkeypatch.setattr(server, "_credit_reward_users", crash_once)
+        await scheduler._load({"shard": 0, "is_active": True})
+        with pytest.raises(SimulatedCrash):
+            await scheduler._process(scheduler._pop_due(now), now)
+        assert scheduler.due_at == {}
+
+        # No shard change follows; the next sync tick takes the pass over once it is stale
+        monkeypatch.setattr(server, "REWARD_PASS_STALE_SECONDS", 0)
+        await scheduler.sync()
+        return await db.reward_passes.find_one({})
+
+    record = asyncio.run(run())
+    user, totals, pending, rewards = state(db)
+    assert record["status"] == "completed"
+    assert record["stakes_paid"] == 2
+    assert user["balance"] == pytest.approx(60.0)
+    assert totals["total_rewards"] == pytest.approx(60.0)
+    assert pending == 0
+    assert rewards == 2
+    assert set(scheduler.due_at) == {"stake-0", "stake-1"}
@@ -0,0 +1,49 @@
+import asyncio
+from datetime import datetime, timedelta
+
+import server
+
+
+def test_analytics_recompute_partial_stats_of_users_that_predate_them(db):
+    start = (datetime.utcnow() - timedelta(days=3)).replace(microsecond=0)
+
+    async def run():
+        # A user and history from before the stats subdocument existed
+        await db.users.insert_one({
+            "id": "legacy", "balance": 0.0, "staked_amount": 150.0, "total_rewards": 0.0, "created_at": start
+        })
+        await db.stakes.insert_many([
+            {
+                "id": "active", "user_id": "legacy", "amount": 100.0, "daily_rate": 0.30,
+                "start_date": start, "last_reward_date": start, "is_active": True, "shard": 0
+            },
+            {
+                "id": "closed", "user_id": "legacy", "amount": 50.0, "daily_rate": 0.30,
+                "start_date": start - timedelta(days=1), "last_reward_date": start, "is_active": False, "shard": 0
+            },
+        ])
+        await db.transactions.insert_many([
+            {"id": "stake-1", "user_id": "legacy", "type": "stake", "amount": 100.0, "status": "completed", "created_at": start},
+            {"id": "stake-2", "user_id": "legacy", "type": "stake", "amount": 50.0, "status": "completed", "created_at": start},
+        ])
+
+        # The first reward after the upgrade $incs a partial stats subdocument
+        batch = await db.stakes.find({"is_active": True}, server.REWARD_STAKE_PROJECTION).to_list(length=None)
+        await server._flush_reward_batch(batch, datetime.utcnow().replace(microsecond=0), "pass-1")
+        partial = (await db.users.find_one({"id": "legacy"}))["stats"]
+        assert "total_invested" not in partial
+
+        analytics = await server._compute_user_analytics("legacy", 7)
+        stored = (await db.users.find_one({"id": "legacy"}))["stats"]
+        return analytics, stored
+
+    analytics, stored = asyncio.run(run())
+    assert analytics["portfolio"]["total_stakes"] == 2
+    assert analytics["portfolio"]["active_stakes"] == 1
+    assert analytics["portfolio"]["completed_stakes"] == 1
+    assert analytics["overview"]["total_invested"] == 150.0
+    assert analytics["milestones"]["biggest_stake"] == 100.0
+    assert analytics["milestones"]["total_transactions"] == 3
+    assert analytics["milestones"]["reward_transactions"] == 1
+    assert stored["version"] == server.USER_STATS_VERSION
+    assert stored["total_transactions"] == 3